@@ -10,15 +10,51 @@ import optparse
 from os.path import expanduser # Handles the conflict between ~ as -inf and ~ as root directory
 import subprocess
 import urllib # Just for urlencode()
+import urlparse
+import httplib
+import socket
 import json
 import shlex
+import ssl
 import signal
+import time
+import threading
+import Queue
+import bisect
+import os
+from collections import deque
 from copy import copy
 
 # Globals
 __PLUGIN_NAME__ = "check_docker.py"
 __VERSION__ = "1.1.0"
 options = ""
+# Idle keep-alive connections to the Docker daemon, reused for the whole run
+docker_connections = []
+# Time by which collections return partial results, set from --timeout
+deadline = None
+# Set once the --timeout alarm went off, nothing may ask the daemon after that
+timed_out = False
+# The /containers/json?all=1 snapshot of this run, see get_container_index()
+container_index = None
+# The /networks snapshot of this run, see get_network_index()
+network_index = None
+# Stats already fetched this run by ID, shared by containers_cpu and containers_memory
+container_stats = {}
+# The resolution cache file's content once read, see load_resolution_cache()
+resolution_cache = None
+# Keys of the entries already found valid (or written) this run, mapped to their time
+resolution_verified = {}
+# Most entries the resolution cache keeps, the least recently used are dropped first
+RESOLUTION_CACHE_MAX_ENTRIES = 1000
+# CPU percentages computed this run by ID, exported with --openmetrics-file
+CPU_usage = {}
+# threshold_string_to_tuple() results by threshold string, see parse_threshold()
+parsed_thresholds = {}
+# 1 or 2 once the cgroup hierarchy under --cgroup-root has been looked at
+cgroup_version = None
+# The host's MemTotal in bytes (0 if unknown), read from /proc/meminfo once per run
+host_memory = None
 
 #could be made to inherit from enum, but not really necessary.
 class check_status():
@@ -45,6 +81,9 @@ def get_options():
              "'/var/run/docker.sock'")
     parser.add_option("-t", "--timeout", default="0", 
         help="Set the timeout duration in seconds. Defaults to never timing out.")
+    parser.add_option("--concurrency", default="8",
+        help="How many containers' stats are requested from the daemon at the same time (containers_cpu, "
+             "containers_memory).")
     parser.add_option("-C", "--containers", 
         help="A (quote-enclosed, comma-delimited) list of container names/ids. If --networks is "
              "set, this will be ignored.")
@@ -54,17 +93,35 @@ def get_options():
     parser.add_option("-I", "--images",
         help="A (quote-enclosed, comma-delimited) list of image names (with tags). If this is set, "
              "--containers/--networks will be ignored. Ex: -I 'ubuntu:latest,tomcat'")
-    parser.add_option("-w", "--warning", default="50", 
-        help="Set the warning threshold.")
-    parser.add_option("-c", "--critical", default="75", 
-        help="Set the critical threshold.")
+    parser.add_option("-w", "--warning", 
+        help="Set the warning threshold. Defaults to 50.")
+    parser.add_option("-c", "--critical", 
+        help="Set the critical threshold. Defaults to 75.")
+    parser.add_option("--warning-for", action="append", default=[], metavar="TYPE=THRESHOLD",
+        help="The warning threshold of one check type when running several, e.g. "
+             "--warning-for containers_memory=512. Repeat for every type; types without "
+             "one use the default of 50 (containers_memory has no default).")
+    parser.add_option("--critical-for", action="append", default=[], metavar="TYPE=THRESHOLD",
+        help="The critical threshold of one check type when running several, like --warning-for. "
+             "Types without one use the default of 75.")
     parser.add_option("--perfdata-max", default="", 
         help="Set the maximum value (used by performance data grapher).")
     parser.add_option("--perfdata-min", default="", 
         help="Set the minimimum value (used by performance data grapher).")
     parser.add_option("--check-type", 
         help="Choose the type of check. Currently implemented: containers_exist, "
-             "containers_running, containers_healthy, containers_cpu, containers_memory")
+             "containers_running, containers_healthy, containers_cpu, containers_memory. "
+             "Give a comma-delimited list or 'all' to run several types in one pass and submit "
+             "one passive result per type.")
+    parser.add_option("--passive-host", default="",
+        help="Host name the passive results are submitted for when running several check types. "
+             "Defaults to the host in --host, or this machine's name for local connections.")
+    parser.add_option("--service-prefix", default="Docker ",
+        help="Prefix of the service descriptions passive results are submitted for; the check "
+             "type is appended. Defaults to 'Docker '.")
+    parser.add_option("--command-file", default="",
+        help="When running several check types, write PROCESS_SERVICE_CHECK_RESULT commands to this "
+             "Nagios command file (or spool file) instead of printing send_nsca input.")
     parser.add_option("--cert", default="", 
         help="The full path to the TLS v1.0 cert to access your secure docker port (remote "
              "connection only).")
@@ -115,8 +172,56 @@ def get_options():
     parser.add_option("--no-individual-checks", action="store_true", default=False, 
         help="For usage statistics, only calculate warning/critical off aggregate metrics like "
              "total/average usage.")
+    parser.add_option("--use-curl", action="store_true", default=False,
+        help="Talk to the Docker daemon by running cURL for every API call instead of using the built-in HTTP client.")
     parser.add_option("--timeout-is-critical", action="store_true", default=False,
         help="When the check times out before completing, plugin returns CRITICAL status instead of UNKNOWN")
+    parser.add_option("--no-cache", action="store_true", default=False,
+        help="Resolve -C/-N/-I to container IDs on every run instead of using the resolution cache. "
+             "The cache is only used by containers_cpu and containers_memory, the other checks "
+             "resolve from the container list they fetch anyway.")
+    parser.add_option("--cache-file", default="~/.check_docker_cache.json",
+        help="Where container ID resolutions are cached between runs. Keep it out of world-writable "
+             "directories such as /tmp. Defaults to ~/.check_docker_cache.json.")
+    parser.add_option("--cache-ttl", default="300",
+        help="How many seconds a cached resolution is used when the daemon's events can't tell "
+             "whether containers or networks changed.")
+    parser.add_option("--cgroup", action="store_true", default=False,
+        help="Read CPU and memory usage straight from the containers' cgroups (cgroup v1 or v2) "
+             "instead of asking the daemon for stats. Only works when run on the Docker host; the "
+             "daemon is still used to resolve names.")
+    parser.add_option("--cgroup-root", default="/sys/fs/cgroup",
+        help="Where the cgroup hierarchy is mounted.")
+    parser.add_option("--cgroup-interval", default="0.5",
+        help="Seconds between the two reads of the CPU counters containers_cpu computes usage from "
+             "with --cgroup.")
+    parser.add_option("--openmetrics-file", default="",
+        help="Also write what the check collected (CPU, memory, running and health state per "
+             "container) to this file in OpenMetrics text format, e.g. for a textfile collector.")
+    parser.add_option("--openmetrics-port", default="",
+        help="Instead of checking, serve --openmetrics-file over HTTP on this port (at /metrics) "
+             "until stopped.")
+    parser.add_option("--openmetrics-address", default="127.0.0.1",
+        help="Address --openmetrics-port listens on. Defaults to 127.0.0.1, use 0.0.0.0 for every "
+             "interface.")
+    parser.add_option("--sampler", action="store_true", default=False,
+        help="Run as a stats sampler that keeps a streaming stats request open for every running "
+             "container and serves their recent CPU samples to --via-sampler checks.")
+    parser.add_option("--sampler-socket", default="~/.check_docker/sampler.sock",
+        help="The unix socket the sampler listens on, in a directory only its user can write to. "
+             "Checks ignore a socket owned by another user.")
+    parser.add_option("--sampler-window", default="10",
+        help="How many CPU samples (about one per second) the sampler keeps per container.")
+    parser.add_option("--sampler-interval", default="10",
+        help="Seconds between two looks for new containers to sample (sampler only).")
+    parser.add_option("--via-sampler", action="store_true", default=False,
+        help="Compute containers_cpu from the sampler's samples instead of asking the daemon for "
+             "stats. Containers the sampler doesn't have are asked for as usual.")
+    parser.add_option("--sampler-average", default="mean",
+        help="How the samples of the window are combined: mean (average over the window), max "
+             "(busiest second) or last (most recent second).")
+    parser.add_option("--sampler-max-age", default="30",
+        help="Ignore samples older than this many seconds.")
     parser.add_option("--debug", action="store_true", default=False)
     # Help is implemented by default by optparse
 
@@ -126,48 +231,136 @@ def get_options():
     if options.version or len(sys.argv) == 1:
         nagios_exit(version, check_status.OK)
 
+    if options.openmetrics_port:
+        if not options.openmetrics_file:
+            nagios_exit("--openmetrics-port needs the --openmetrics-file to serve", check_status.UNKNOWN)
+        try:
+            options.openmetrics_port = int(options.openmetrics_port)
+        except ValueError:
+            nagios_exit("--openmetrics-port must be a number", check_status.UNKNOWN)
+        return options
+
+    if not options.host:
+        nagios_exit("Please specify the host address of your docker API", 3)
+
+    if options.host[-1] != "/":
+        options.host += "/"
+
+    try:
+        options.sampler_window = max(2, int(options.sampler_window))
+        options.sampler_interval = max(1, int(options.sampler_interval))
+        options.sampler_max_age = int(options.sampler_max_age)
+    except ValueError:
+        nagios_exit("--sampler-window, --sampler-interval and --sampler-max-age must be numbers", check_status.UNKNOWN)
+    if options.sampler_average not in sampler_averages:
+        nagios_exit("Invalid --sampler-average. Pick one of " + str(sampler_averages.keys()), check_status.UNKNOWN)
+    options.sampler_socket = expanduser(options.sampler_socket)
+
+    if options.sampler:
+        # the sampler streams over the built-in client, there is no cURL fallback
+        if needs_curl_for_tls(options):
+            nagios_exit("The sampler needs Python 2.7.9 or later to talk to the Docker daemon over https", check_status.UNKNOWN)
+        return options
+
+    options.cache_file = expanduser(options.cache_file)
+    try:
+        options.cache_ttl = int(options.cache_ttl)
+    except ValueError:
+        nagios_exit("--cache-ttl must be a number", check_status.UNKNOWN)
+
+    try:
+        options.cgroup_interval = max(0.01, float(options.cgroup_interval))
+    except ValueError:
+        nagios_exit("--cgroup-interval must be a number", check_status.UNKNOWN)
+
     global valid_checks
     check_types = valid_checks.keys()
     if not options.check_type:
         nagios_exit("No check type specified. Check types: " + str(check_types), 3)
     options.check_type = options.check_type.lower()
-    if options.check_type not in check_types:
-        nagios_exit("Check type not supported.", 3, "", "Check types: " + str(check_types))
-    if options.check_type == "containers_cpu":
-        options.percentage = True
+    if options.check_type == "all":
+        options.check_types = sorted(check_types)
+    else:
+        options.check_types = [t.strip() for t in options.check_type.split(",") if t.strip()]
+    for check_type in options.check_types:
+        if check_type not in check_types:
+            nagios_exit("Check type not supported.", 3, "", "Check types: " + str(check_types))
+    options.multiple = len(options.check_types) > 1 or options.check_type == "all"
 
     if options.perfdata_min > options.perfdata_max:
         nagios_exit("--perfdata-max must be larger than --perfdata-min", 3)
 
-    if not options.host:
-        nagios_exit("Please specify the host address of your docker API", 3)
+    if "containers_memory" in options.check_types and options.memory_unit not in unit_dict.keys():
+        nagios_exit("Invalid unit. Pick one of " + str(unit_dict.keys()), check_status.UNKNOWN)
 
-    if options.check_type != "containers_memory":
-        options.memory_unit = "%"
+    options.warnings_for = parse_thresholds_for(options.warning_for, "--warning-for", options.check_types)
+    options.criticals_for = parse_thresholds_for(options.critical_for, "--critical-for", options.check_types)
+    if options.multiple:
+        # One -w/-c can't fit counts, CPU percentages and memory sizes at once
+        if options.warning is not None or options.critical is not None:
+            nagios_exit("-w and -c don't apply to several check types, give each type its thresholds "
+                        "with --warning-for TYPE=THRESHOLD and --critical-for TYPE=THRESHOLD", check_status.UNKNOWN)
+        if "containers_memory" in options.check_types and not ("containers_memory" in options.warnings_for
+                                                              and "containers_memory" in options.criticals_for):
+            nagios_exit("containers_memory has no default thresholds, give them with "
+                        "--warning-for containers_memory=... and --critical-for containers_memory=...", check_status.UNKNOWN)
+    else:
+        options.warnings_for[options.check_types[0]] = options.warnings_for.get(options.check_types[0], options.warning)
+        options.criticals_for[options.check_types[0]] = options.criticals_for.get(options.check_types[0], options.critical)
+        options = options_for_check_type(options, options.check_types[0])
 
-    if options.check_type == "containers_memory" and options.memory_unit:
-        options.warning = scale_threshold_list(options.warning, options.memory_unit)
-        options.critical = scale_threshold_list(options.critical, options.memory_unit)
+    if options.multiple and not options.passive_host:
+        host = urlparse.urlparse(options.host).hostname
+        options.passive_host = host if host and not options.socket else socket.gethostname()
 
-    if options.memory_unit not in unit_dict.keys():
-        nagios_exit("Invalid unit. Pick one of " + str(unit_dict.keys()), check_status.UNKNOWN)
+    # TLS needs an SSLContext (Python 2.7.9+), otherwise leave it to cURL.
+    if needs_curl_for_tls(options):
+        options.use_curl = True
 
-    # Make the cURL options command-line-ready.
-    if options.host[-1] != "/":
-        options.host += "/"
-    if options.socket:
-        options.socket = "--unix-socket " + options.socket
-    if options.cert:
-        options.cert = "--cert " + options.cert
-    if options.key:
-        options.key = "--key " + options.key
-    if options.cacert:
-        options.cacert = "--cacert " + options.cacert
+    try:
+        options.concurrency = max(1, int(options.concurrency))
+    except ValueError:
+        nagios_exit("--concurrency must be a number", check_status.UNKNOWN)
 
     set_timeout(int(options.timeout))
 
     return options
 
+# Parses the TYPE=THRESHOLD values of --warning-for/--critical-for into a dictionary
+def parse_thresholds_for(values, option, check_types):
+    thresholds = {}
+    for value in values:
+        check_type, _, threshold = value.partition("=")
+        check_type = check_type.strip().lower()
+        if not threshold or check_type not in check_types:
+            nagios_exit("%s takes TYPE=THRESHOLD for one of the check types run: %s" % (option, value), check_status.UNKNOWN)
+        thresholds[check_type] = threshold
+    return thresholds
+
+# https without the SSLContext API (Python < 2.7.9) is left to cURL
+def needs_curl_for_tls(options):
+    return (not options.socket and urlparse.urlparse(options.host).scheme == "https"
+            and not hasattr(ssl, "create_default_context"))
+
+# Returns a copy of options with the settings a single check type implies (thresholds scaled
+# to the memory unit, CPU as a percentage), so several types can run off the same command line.
+def options_for_check_type(options, check_type):
+    options = copy(options)
+    options.check_type = check_type
+    options.warning = options.warnings_for.get(check_type) or "50"
+    options.critical = options.criticals_for.get(check_type) or "75"
+    if check_type == "containers_cpu":
+        options.percentage = True
+
+    if check_type != "containers_memory":
+        options.memory_unit = "%"
+
+    if check_type == "containers_memory" and options.memory_unit:
+        options.warning = scale_threshold_list(options.warning, options.memory_unit)
+        options.critical = scale_threshold_list(options.critical, options.memory_unit)
+
+    return options
+
 def choose_checks(options):
 
     attributes_count = 1
@@ -198,12 +391,23 @@ def choose_checks(options):
         selection_type = 'all'
         selection = ['all']
 
+    cache_key = None
+    if not options.no_cache and resolution_cache_useful(options):
+        cache_key = json.dumps([options.socket, options.host, selection_type, selection])
+        cached = get_cached_resolution(cache_key)
+        if cached is not None:
+            selection = cached
+            selection_type = 'cached'
+
+    if options.all and selection_type != 'cached':
+        selection = {'all': get_all_container_IDs()}
+
     if options.debug:
         print selection_type
         print selection
         print "End selection + type"
 
-    if not options.all:
+    if not options.all and selection_type != 'cached':
         # This is a switch!
         selection_function = {
             'containers': containers_list_to_dict,
@@ -217,6 +421,9 @@ def choose_checks(options):
             nagios_exit("None of the listed containers/networks exist!", check_status.CRITICAL, "",
                 "Plugin tried to find matching containers from IDs/names specified by -C/-N/-I, but none were found on the docker machine.")
 
+    if cache_key and selection_type != 'cached':
+        cache_resolution(cache_key, selection)
+
 
     new_dict = {}
     if options.total_usage: 
@@ -236,15 +443,20 @@ def choose_checks(options):
 # timeout should default to zero
 
 def timeout_handler(signal, frame):
-    global options
+    global options, timed_out
+    timed_out = True
     timeout_status = check_status.UNKNOWN
     if options.timeout_is_critical:
         timeout_status = check_status.CRITICAL
     nagios_exit("check timed out", timeout_status)
 
 def set_timeout(seconds):
+    global deadline
     signal.signal(signal.SIGALRM, timeout_handler)
     signal.alarm(seconds)
+    # Slow collections stop here and report what they have before the alarm goes off
+    if seconds:
+        deadline = time.time() + seconds * 0.9
 
 def scale_threshold(threshold, multiplier):
     out_str = ""
@@ -285,14 +497,18 @@ def nagios_exit(out, code, perfdata="", verbose_out=""):
     print out
     exit(code)
 
-class CheckData:
+# One per selected alias, or per container with --separate-containers, so keep them small
+class CheckData(object):
+    __slots__ = ('name', 'warning_text', 'warning_parsed', 'critical_text', 'critical_parsed',
+                 'container_IDs', 'value', 'RC')
+
     def __init__(self, name, warning_text, critical_text, container_IDs):
         self.name = name
         # Raw text is saved so that the thresholds can be printed when writing out perfdata
         self.warning_text = warning_text
-        self.warning_parsed = threshold_string_to_tuple(warning_text)
+        self.warning_parsed = parse_threshold(warning_text)
         self.critical_text = critical_text
-        self.critical_parsed = threshold_string_to_tuple(critical_text)
+        self.critical_parsed = parse_threshold(critical_text)
         self.container_IDs = container_IDs
 
     def setValue(self, value):
@@ -302,12 +518,9 @@ class CheckData:
         self.RC = value
 
     def to_individual_containers(self):
-        ret = dict((x, copy(self)) for x in self.container_IDs)
-
-        for new_name in ret.keys():
-            ret[new_name].name = new_name
-            ret[new_name].container_IDs = [new_name]
-        return ret
+        # copy() of a __slots__ object goes through __reduce_ex__, a new CheckData is cheaper
+        # (the thresholds are parsed already, parse_threshold() only looks them up)
+        return dict((x, CheckData(x, self.warning_text, self.critical_text, [x])) for x in self.container_IDs)
 
 # Takes the threshold mapping, adjusts it so that thresholds are assigned to individual containers
 def separate_checks(checks):
@@ -331,6 +544,14 @@ def get_threshold_maps(warning_in, critical_in, attrs):
 
     return check_data_map
 
+# threshold_string_to_tuple() once per distinct threshold, the tuples are shared by all checks
+def parse_threshold(threshold_string):
+    try:
+        return parsed_thresholds[threshold_string]
+    except KeyError:
+        parsed = parsed_thresholds[threshold_string] = threshold_string_to_tuple(threshold_string)
+        return parsed
+
 # Takes a standard nagios threshold, like @10:20, and 
 # turns it into a 3-tuple (low, high, inclusive), like '(10, 20, true)
 def threshold_string_to_tuple(threshold_string):
@@ -376,36 +597,34 @@ def threshold_string_to_tuple(threshold_string):
 # checks the list of values against the threshold object returned by get_thresholds
 def check_all_values_against_thresholds(check_data):
     if options.debug: print "hit " + "check_all_values_against_thresholds"
+    # Checks with the same thresholds are evaluated together with one compiled test each
+    groups = {}
+    for check in check_data.itervalues():
+        groups.setdefault((check.warning_parsed, check.critical_parsed), []).append(check)
+
     highest_value = check_status.OK
-    for key in check_data.keys():
-        return_code = check_against_thresholds(check_data[key].value, check_data[key].warning_parsed, check_data[key].critical_parsed)
-        check_data[key].setRC(return_code)
-        if highest_value < return_code:
-            highest_value = return_code
+    for (warning_tuple, critical_tuple), checks in groups.iteritems():
+        warn = compile_threshold(warning_tuple)
+        crit = compile_threshold(critical_tuple)
+        for check in checks:
+            if crit(check.value):
+                return_code = check_status.CRITICAL
+            elif warn(check.value):
+                return_code = check_status.WARNING
+            else:
+                return_code = check_status.OK
+            check.RC = return_code
+            if highest_value < return_code:
+                highest_value = return_code
     return highest_value
 
-def check_against_thresholds(value, warning_tuple, critical_tuple):
-    if options.debug: print "hit " + "check_against_thresholds"
-    crit = check_against_threshold(value, critical_tuple)
-    if crit:
-        return check_status.CRITICAL
-    warn = check_against_threshold(value, warning_tuple)
-    if warn:
-        return check_status.WARNING
-    return check_status.OK
-
-def check_against_threshold(value, threshold_tuple):
-    if options.debug: print "hit " + "check_against_threshold"
-    if threshold_tuple[2]:
-        if value < threshold_tuple[0] or value > threshold_tuple[1]:
-            return False
-        else:
-            return True
-    else:
-        if value < threshold_tuple[0] or value > threshold_tuple[1]:
-            return True
-        else:
-            return False
+# Takes a tuple from threshold_string_to_tuple() and returns a function telling whether a value
+# is outside the range, or inside it for inclusive (@) thresholds
+def compile_threshold(threshold_tuple):
+    low, high, inclusive = threshold_tuple
+    if inclusive:
+        return lambda value: low <= value <= high
+    return lambda value: value < low or value > high
 
 def make_perfdata(check_dict, uom, perf_min, perf_max):
     full_string = " | "
@@ -445,7 +664,22 @@ def unicode_encode_list(l):
 # Returns a JSON object
 def talk_to_docker(endpoints_list, form_values_list, crash_on_fail=True):
     if options.debug: print "hit " + "talk_to_docker"
+    return_string, err = get_from_docker(endpoints_list, form_values_list)
+    if not return_string:
+        if options.debug:
+            print "ERR " + err
+            print "STDOUT " + return_string  
+        if crash_on_fail:
+            nagios_exit("Docker API call failed", check_status.UNKNOWN, "", "Stderr: " + err)
+        else:
+            return None
 
+    # Convert to JSON
+    return_object = json.loads(return_string)
+    return return_object # Note: all strings are unicode!
+
+# Makes a single API call. Returns the raw response body and an error message, empty on success.
+def get_from_docker(endpoints_list, form_values_list):
     # Construct the full URL
     endpoints = "/".join(endpoints_list)
     form_values = "?"
@@ -455,74 +689,106 @@ def talk_to_docker(endpoints_list, form_values_list, crash_on_fail=True):
     full_url = options.host + endpoints + form_values 
 
     # Talk to Docker
-    cmd = "curl %s '%s' -g -f %s %s %s" % (options.socket, full_url, options.cert, options.key, options.cacert)
-    #cmd = "curl " + options.socket + " '" + full_url + "' -g -f " + \
-    #      options.cert + " " + options.key + " " + options.cacert
+    if options.use_curl:
+        return curl_docker(full_url)
+    return request_docker(full_url)
+
+# Runs cURL for a single API call. Returns the response body and stderr.
+def curl_docker(full_url):
+    if options.debug: print "hit " + "curl_docker"
+    curl_options = ""
+    if options.socket:
+        curl_options += " --unix-socket " + options.socket
+    cmd = "curl%s '%s' -g -f" % (curl_options, full_url)
+    if options.cert:
+        cmd += " --cert " + options.cert
+    if options.key:
+        cmd += " --key " + options.key
+    if options.cacert:
+        cmd += " --cacert " + options.cacert
     if options.debug: print str(cmd)
     args = shlex.split(cmd.encode('ascii'))
     p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return_string, err = p.communicate()
-    if not return_string:
-        if options.debug:
-            print "ERR " + err
-            print "STDOUT " + return_string  
-        if crash_on_fail:
-            nagios_exit("cURL call failed", check_status.UNKNOWN, "", "Stderr: " + err)
-        else:
-            return None
-
-    # Convert to JSON
-    return_object = json.loads(return_string)
-    return return_object # Note: all strings are unicode!
+    out, err = p.communicate()
+    if p.returncode == 0:
+        err = ""
+    elif not err:
+        err = "curl exited with %d" % p.returncode
+    return out, err
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+def new_docker_connection():
+    if options.debug: print "hit " + "new_docker_connection"
+    if options.socket:
+        return UnixHTTPConnection(options.socket)
+    url = urlparse.urlparse(options.host)
+    if url.scheme == "https":
+        context = ssl.create_default_context(cafile=(options.cacert or None))
+        if options.cert:
+            context.load_cert_chain(options.cert, options.key or None)
+        return httplib.HTTPSConnection(url.hostname, url.port, context=context)
+    return httplib.HTTPConnection(url.hostname, url.port)
+
+# Returns the path and query the request line of full_url needs
+def url_to_path(full_url):
+    url = urlparse.urlparse(full_url)
+    path = url.path
+    if url.query:
+        path += "?" + url.query
+    return path
+
+# Sends a single API call over a pooled HTTP/1.1 keep-alive connection.
+# Returns the response body (empty on failure, like curl -f) and an error message.
+def request_docker(full_url):
+    if options.debug: print "hit " + "request_docker"
+    path = url_to_path(full_url)
+    while True:
+        try:
+            connection = docker_connections.pop()
+            reused = True
+        except IndexError:
+            connection = new_docker_connection()
+            reused = False
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            connection.close()
+            if reused:
+                # The daemon closed an idle connection, retry on a new one
+                continue
+            return "", str(e)
+        break
+
+    if response.will_close:
+        connection.close()
+    else:
+        docker_connections.append(connection)
+    if response.status >= 400:
+        return "", "HTTP %d %s: %s" % (response.status, response.reason, body)
+    return body, ""
 
 def get_container_IDs_from_names(names):
     if options.debug: print "hit " + "get_container_IDs_from_names"
     if isinstance(names, basestring):
         names = [names]
-    endpoints_list = ['containers', 'json']
+    by_name = get_container_index()['by_name']
     ID_list = []
     for name in names:
-        form_values_list = ['filters={"name":["' + name + '"]}', 'all=true']
-        candidates = talk_to_docker(endpoints_list, form_values_list)
-        for c in candidates:
-            for name_ in c['Names']:
-                if name_ == name or name_ == "/" + name:
-                    ID_list.append(c['Id'])
-                    break
+        if name.startswith("/"):
+            name = name[1:]
+        ID_list += by_name.get(name, [])
     return ID_list
 
-def get_container_IDs_from_network_IDs(network_IDs):
-    if options.debug: print "hit " + "get_container_IDs_from_network_IDs"
-    if isinstance(network_IDs, basestring):
-        network_IDs = [network_IDs]
-    form_values_list = []
-    container_IDs = []
-    for ID in network_IDs:
-        endpoints_list = ['networks', ID]
-        network = talk_to_docker(endpoints_list, form_values_list)
-        container_list = network["Containers"]
-        for container_ID, data in container_list:
-            container_IDs.append(container_ID)
-    return container_IDs
-
-def get_container_IDs_from_network_names(names):
-    if options.debug: print "hit " + "get_container_IDs_from_network_names"
-    if isinstance(names, basestring):
-        names = [names]
-    endpoints_list = 'networks'
-    container_IDs = []
-    for name in names:
-        form_values_list = ['filters={"name":["' + name + '"]}', 'all=1']
-        json_object = talk_to_docker(endpoints_list, form_values_list)
-        ID = ""
-        for network in json_object:
-            if network['Name'] == name or network['Name'] == ("/" + name):
-                ID = network['Id']
-                break;
-        if ID:
-            container_IDs += get_container_IDs_from_network_IDs(ID)
-    return container_IDs
-
 # Takes the container json object from talk_to_docker(), and the name of the image we're looking for
 # returns a list of container IDs
 def filter_containers_by_image_name(containers, image_name):
@@ -538,12 +804,41 @@ def images_list_to_dict(images_list):
     return ret_dict
 
 
+# Fetches every container once per run and indexes them by full ID and by name.
+# IDs are also kept sorted so that ID prefixes can be looked up with a bisection.
+def get_container_index():
+    global container_index
+    if container_index is None:
+        if options.debug: print "hit get_container_index"
+        containers = talk_to_docker(["containers", "json"], ["all=1"])
+        by_ID = {}
+        by_name = {}
+        for container in containers:
+            by_ID[container['Id']] = container
+            for name in container['Names']:
+                if name.startswith("/"):
+                    name = name[1:]
+                by_name.setdefault(name, []).append(container['Id'])
+        container_index = {
+            'containers': containers,
+            'by_ID': by_ID,
+            'by_name': by_name,
+            'sorted_IDs': sorted(by_ID.keys()),
+        }
+    return container_index
+
+# Returns the full ID of the first container whose ID starts with prefix, or None
+def find_container_ID(prefix):
+    if options.debug: print "hit find_container_ID"
+    sorted_IDs = get_container_index()['sorted_IDs']
+    i = bisect.bisect_left(sorted_IDs, prefix)
+    if i < len(sorted_IDs) and sorted_IDs[i].startswith(prefix):
+        return sorted_IDs[i]
+    return None
+
 def get_all_containers():
     if options.debug: print "hit get_all_containers"
-    endpoints_list = ["containers", "json"]
-    form_values_list = ["all=1"]
-    all_containers = talk_to_docker(endpoints_list, form_values_list)
-    return all_containers
+    return get_container_index()['containers']
 
 def get_all_container_IDs():
     if options.debug: print "hit " + "get_all_container_IDs"
@@ -571,84 +866,186 @@ def containers_list_to_dict(container_list):
     ret_dict = {}
     for container in container_list:
         ret_dict[container] = []
-        json_object = is_docker_container_ID(container)
-        if json_object:
-            ret_dict[container].append(json_object['Id'])
+        ID = find_container_ID(container)
+        if ID:
+            ret_dict[container].append(ID)
         else:
-            json_object = is_docker_container_name(container)
-            if json_object:
-                ret_dict[container] += get_container_IDs_from_names(container)
+            ret_dict[container] += get_container_IDs_from_names(container)
     return ret_dict
 
 # returns a dictionary of network names/ids associated with a list of container IDs.
 def networks_list_to_dict(network_list):
     if options.debug: print "hit " + "networks_list_to_dict"
+    networks = dict((value, find_network(value)) for value in network_list)
+    members = get_network_members([network for network in networks.values() if network])
     ret_dict = {}
-    for network in network_list:
-        ret_dict[network] = []
-        if is_docker_network_ID(network):
-            ret_dict[network] += get_container_IDs_from_network_IDs(network)
-        elif is_docker_network_name(network):
-            ret_dict[network] += get_container_IDs_from_network_names(network)
+    for value, network in networks.iteritems():
+        ret_dict[value] = members[network['Id']] if network else []
     return ret_dict
 
-def is_docker_network_ID(value):
-    if options.debug: print "hit " + "is_docker_network_ID"
-    endpoints_list = ['networks']
-    form_values_list = ['filters={"id":["' + value + '"]}', 'all=1']
-    json_object = talk_to_docker(endpoints_list, form_values_list)
-    if json_object:
-        return json_object[0]
-    return False
-
-def is_docker_container_ID(value):
-    if options.debug: print "hit " + "is_docker_container_ID"
-    endpoints_list = ['containers', 'json']
-    form_values_list = ['filters={"id":["' + value + '"]}', 'all=1']
-    json_object = talk_to_docker(endpoints_list, form_values_list)
-    if json_object:
-        return json_object[0]
-    return False
-
-def is_docker_container_name(value):
-    if options.debug: print "hit is_docker_container_name"
-    endpoints_list = ['containers', 'json']
-    form_values_list = ['filters={"name":["' + value + '"]}', 'all=true']
-    json_object = talk_to_docker(endpoints_list, form_values_list)
-    if json_object:
-        return json_object[0]
-    return None
-
-def is_docker_network_name(value):
-    if options.debug: print "hit is_docker_network_name"
-    endpoints_list = ['networks']
-    container_IDs = []
-    form_values_list = ['filters={"name":["' + value + '"]}', 'all=1']
-    json_object = talk_to_docker(endpoints_list, form_values_list)
-    if json_object:
-        return json_object[0]
-    return None
+# Fetches every network once per run and indexes them by full ID and by name,
+# like get_container_index()
+def get_network_index():
+    global network_index
+    if network_index is None:
+        if options.debug: print "hit get_network_index"
+        networks = talk_to_docker(["networks"], [])
+        by_ID = dict((network['Id'], network) for network in networks)
+        network_index = {
+            'by_ID': by_ID,
+            'by_name': dict((network['Name'], network) for network in networks),
+            'sorted_IDs': sorted(by_ID.keys()),
+        }
+    return network_index
+
+# Returns the network whose ID starts with value or that is named value, or None
+def find_network(value):
+    if options.debug: print "hit find_network"
+    index = get_network_index()
+    sorted_IDs = index['sorted_IDs']
+    i = bisect.bisect_left(sorted_IDs, value)
+    if i < len(sorted_IDs) and sorted_IDs[i].startswith(value):
+        return index['by_ID'][sorted_IDs[i]]
+    if value.startswith("/"):
+        value = value[1:]
+    return index['by_name'].get(value)
+
+# Returns a dictionary of network ID to the IDs of the containers attached to it.
+# Containers list their networks in NetworkSettings, so this normally costs no API call; only
+# daemons that don't report them get each network inspected.
+def get_network_members(networks):
+    if options.debug: print "hit get_network_members"
+    members = dict((network['Id'], []) for network in networks)
+    containers = get_all_containers()
+    if all(['NetworkSettings' in container for container in containers]):
+        by_name = get_network_index()['by_name']
+        for container in containers:
+            for name, endpoint in (container['NetworkSettings'].get('Networks') or {}).iteritems():
+                # Stopped containers keep their networks, but without a NetworkID
+                network_ID = endpoint.get('NetworkID') or by_name.get(name, {}).get('Id')
+                if network_ID in members:
+                    members[network_ID].append(container['Id'])
+    else:
+        for network_ID in members.keys():
+            inspected = talk_to_docker(['networks', network_ID], [])
+            members[network_ID] = (inspected.get('Containers') or {}).keys()
+    return members
 
 #END API HELPERS
 
+# Checks run in parallel, so data is written to a private temporary file that is then moved over
+# path. mkstemp() creates it exclusively (no following a symlink planted under a predictable name)
+# and readable by this user only, unless a mode is given.
+def write_file_atomically(path, data, mode=None):
+    import tempfile
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_file = tempfile.mkstemp(prefix=name + ".", dir=directory)
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        f = os.fdopen(fd, "w")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(temp_file, path)
+    except:
+        try:
+            os.unlink(temp_file)
+        except OSError:
+            pass
+        raise
+
+#START RESOLUTION CACHE
+
+# Resolving -C/-N/-I/-a to container IDs is cached in --cache-file, keyed by daemon and selection.
+# An entry stays valid as long as the daemon reports no container create/destroy/rename or
+# network connect/disconnect event since it was last used. If the events can't be read,
+# entries are used for --cache-ttl seconds.
+
+# The /containers/json snapshot resolves selections as well, so the cache only saves calls when
+# nothing in the run fetches it: the exist, running and healthy checks (also as another type
+# of the same run), -a, --cgroup and --openmetrics-file all do.
+def resolution_cache_useful(options):
+    for check_type in options.check_types:
+        if check_type not in ("containers_cpu", "containers_memory"):
+            return False
+    return not options.all and not options.cgroup and not options.openmetrics_file and container_index is None
+
+def load_resolution_cache():
+    global resolution_cache
+    if resolution_cache is None:
+        try:
+            f = open(options.cache_file)
+            try:
+                # Resolutions planted by another user would decide which containers are checked
+                if os.fstat(f.fileno()).st_uid != os.getuid():
+                    raise IOError("%s is not owned by this user" % options.cache_file)
+                resolution_cache = json.load(f)
+            finally:
+                f.close()
+            if not isinstance(resolution_cache, dict):
+                resolution_cache = {}
+        except (IOError, ValueError):
+            resolution_cache = {}
+    return resolution_cache
+
+def save_resolution_cache():
+    cache = load_resolution_cache()
+    if len(cache) > RESOLUTION_CACHE_MAX_ENTRIES:
+        for key in sorted(cache.keys(), key=lambda k: cache[k]['time'])[:len(cache) - RESOLUTION_CACHE_MAX_ENTRIES]:
+            del cache[key]
+    try:
+        write_file_atomically(options.cache_file, json.dumps(cache))
+    except (IOError, OSError), e:
+        if options.debug: print "could not write the resolution cache: " + str(e)
+
+# Returns True if containers or networks changed since, False if not, None if the daemon can't tell
+def resolution_changed_since(since):
+    if options.debug: print "hit " + "resolution_changed_since"
+    filters = json.dumps({"type": ["container", "network"],
+                          "event": ["create", "destroy", "rename", "connect", "disconnect"]},
+                         separators=(",", ":"))
+    # The response is one JSON document per event, so any content means a change
+    events, err = get_from_docker(["events"], ["since=%d" % (since - 1), "until=%d" % time.time(), "filters=" + filters])
+    if err:
+        return None
+    return bool(events.strip())
+
+def get_cached_resolution(key):
+    if options.debug: print "hit " + "get_cached_resolution"
+    entry = load_resolution_cache().get(key)
+    if not entry:
+        return None
+    if entry['time'] == resolution_verified.get(key):
+        # Already checked by another check type of this run
+        changed = False
+    else:
+        changed = resolution_changed_since(entry['time'])
+    if changed or (changed is None and time.time() - entry['time'] > options.cache_ttl):
+        return None
+    if changed is False:
+        entry['time'] = resolution_verified[key] = time.time()
+        save_resolution_cache()
+    return dict((str(alias), list(IDs)) for alias, IDs in entry['selection'].iteritems())
+
+def cache_resolution(key, selection):
+    if options.debug: print "hit " + "cache_resolution"
+    # A copy, choose_checks() goes on to add the total/average aliases to selection
+    load_resolution_cache()[key] = {'time': time.time(),
+                                    'selection': dict((alias, list(IDs)) for alias, IDs in selection.iteritems())}
+    resolution_verified[key] = load_resolution_cache()[key]['time']
+    save_resolution_cache()
+
+#END RESOLUTION CACHE
+
 #START CHECK BLOCK
 
 def check_containers_exist(ID_list):
     if options.debug: print "hit " + "check_containers_exist"
-    missing_IDs = []
-    endpoints_list = ["containers", "json"]
-    form_values_list = ["all=true"]
-    values = talk_to_docker(endpoints_list, form_values_list)
-    counter = 0
-    for ID in ID_list:
-        exists = False
-        for v in values:
-            if(v["Id"] == ID):
-                exists = True
-        if not exists:
-            missing_IDs.append(ID)
-        else:
-            counter += 1
+    by_ID = get_container_index()['by_ID']
+    missing_IDs = [ID for ID in ID_list if ID not in by_ID]
+    counter = len(ID_list) - len(missing_IDs)
     out = "%d containers found" % (counter)
     if missing_IDs and options.list_bad_containers:
         out += (". No containers found with IDs %s" % (unicode_encode_list(missing_IDs)))
@@ -656,24 +1053,18 @@ def check_containers_exist(ID_list):
 
 def check_containers_running(ID_list):
     if options.debug: print "hit " + "check_containers_running"
-
-    endpoints_list = ["containers","json"]
-    form_values_list = ['all=true']
-    json_object = talk_to_docker(endpoints_list, form_values_list)
+    by_ID = get_container_index()['by_ID']
 
     not_running = []
     running = []
     for ID in ID_list:
-        is_running = False
-        for container in json_object:
-            if ID == container["Id"]:
-                if container["State"] == "Running":
-                    running.append(container["Names"][0])
-                else:
-                    not_running.append(container["Names"][0])
-                break
-        else:
+        container = by_ID.get(ID)
+        if container is None:
             not_running.append(ID)
+        elif container["State"].lower() == "running":
+            running.append(container["Names"][0])
+        else:
+            not_running.append(container["Names"][0])
 
     running_count = len(running)
     not_running_count = len(not_running)
@@ -693,40 +1084,20 @@ def check_containers_running(ID_list):
 
 def check_containers_healthy(ID_list):
     if options.debug: print "hit " + "check_containers_healthy"
-    endpoints_list = ["containers","json"]
-
-    form_values_list = ['filters={"health":["unhealthy"]}']
-    json_object_unhealthy = talk_to_docker(endpoints_list, form_values_list)
-
-    if options.debug: print "json_object_unhealthy " + str(json_object_unhealthy)
-
-    form_values_list = ['filters={"health":["healthy"]}']
-    json_object_healthy = talk_to_docker(endpoints_list, form_values_list)
-
-    if options.debug: print "json_object_healthy " + str(json_object_healthy)
+    # The Status of the snapshot ends in "(healthy)" or "(unhealthy)", as the health filter
+    # of /containers/json matches them, so the one index serves both lists
+    by_ID = get_container_index()['by_ID']
 
     unhealthy = []
     healthy = []
     no_check = []
     for ID in ID_list:
-
-        missing_healthy = False
-        for container in json_object_healthy:
-            if ID == container['Id']:
-                healthy.append(container['Names'][0])
-                break
+        status = by_ID[ID].get('Status', "") if ID in by_ID else ""
+        if "(healthy)" in status:
+            healthy.append(by_ID[ID]['Names'][0])
+        elif "(unhealthy)" in status:
+            unhealthy.append(by_ID[ID]['Names'][0])
         else:
-            missing_healthy = True
-
-        missing_unhealthy = False
-        for container in json_object_unhealthy:
-            if ID == container['Id']:
-                unhealthy.append(container['Names'][0])
-                break
-        else:
-            missing_unhealthy = True
-
-        if missing_healthy and missing_unhealthy:
             no_check.append(ID) # Technically includes "starting".
 
     if options.debug:
@@ -765,14 +1136,78 @@ def check_containers_healthy(ID_list):
     return (out, counter)
 
 
+# Requests /containers/<id>/stats for every ID on --concurrency threads.
+# Returns a dictionary of ID to stats and the IDs with no stats, either because the
+# call failed or because the deadline was reached first.
+def get_containers_stats(ID_list):
+    if options.debug: print "hit " + "get_containers_stats"
+    if options.cgroup:
+        return get_cgroup_stats(ID_list)
+    pending = Queue.Queue()
+    to_fetch = [ID for ID in ID_list if ID not in container_stats]
+    for ID in to_fetch:
+        pending.put(ID)
+    results = Queue.Queue()
+
+    def worker():
+        try:
+            while True:
+                try:
+                    ID = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    json_object = talk_to_docker(["containers", ID, "stats"], ['stream=false'], False)
+                except Exception:
+                    json_object = None
+                results.put((ID, json_object))
+        except:
+            # The interpreter is shutting down under a worker abandoned at the deadline
+            return
+
+    workers = []
+    for _ in range(min(options.concurrency, len(to_fetch))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    stats = dict((ID, container_stats[ID]) for ID in ID_list if ID in container_stats)
+    for _ in to_fetch:
+        try:
+            if deadline:
+                ID, json_object = results.get(True, max(0, deadline - time.time()))
+            else:
+                ID, json_object = results.get()
+        except Queue.Empty:
+            break
+        if json_object is not None:
+            stats[ID] = container_stats[ID] = json_object
+    else:
+        # Everything answered, let the workers finish before the plugin exits
+        for t in workers:
+            t.join()
+    missing = [ID for ID in ID_list if ID not in stats]
+    return stats, missing
+
+def partial_output(missing):
+    if not missing:
+        return ""
+    out = "Partial result, no stats for %d containers" % len(missing)
+    if options.list_bad_containers:
+        out += " %s" % unicode_encode_list([ID[:12] for ID in missing])
+    return out + ". "
+
 def check_containers_CPU(ID_list):
     if options.debug: print "hit " + "check_containers_CPU"
-    form_values_list = ['stream=false']
     usage_dict = {}
     total_usage = 0
-    for ID in ID_list:
-        endpoints_list = ["containers", ID, "stats"]
-        json_object = talk_to_docker(endpoints_list, form_values_list)
+    if options.via_sampler:
+        usage_dict = sampler_CPU_usage(ID_list)
+        total_usage = sum(usage_dict.values())
+        ID_list = [ID for ID in ID_list if ID not in usage_dict]
+    stats, missing = get_containers_stats(ID_list)
+    for ID, json_object in stats.iteritems():
         if 'system_cpu_usage' in json_object['cpu_stats'].keys() and 'system_cpu_usage' in json_object['precpu_stats'].keys():
             container_CPU_delta = json_object['cpu_stats']['cpu_usage']['total_usage'] - json_object['precpu_stats']['cpu_usage']['total_usage']
             system_CPU_delta = json_object['cpu_stats']['system_cpu_usage'] - json_object['precpu_stats']['system_cpu_usage']
@@ -786,17 +1221,16 @@ def check_containers_CPU(ID_list):
         percent_usage = container_CPU_delta/float(system_CPU_delta) * 100
         total_usage += percent_usage
         usage_dict[ID] = percent_usage
-    return ("", [total_usage, usage_dict])
+    CPU_usage.update(usage_dict)
+    return (partial_output(missing), [total_usage, usage_dict])
 
 def check_containers_memory(ID_list):
     if options.debug: print "hit " + "check_containers_memory"
     if options.debug: print "ID_list is " + str(ID_list)
-    form_values_list = ['stream=false']
     usage_dict = {}
     total_usage = 0
-    for ID in ID_list:
-        endpoints_list = ["containers", ID, "stats"]
-        json_object = talk_to_docker(endpoints_list, form_values_list)
+    stats, missing = get_containers_stats(ID_list)
+    for ID, json_object in stats.iteritems():
         if 'usage' in json_object['memory_stats'].keys() and 'limit' in json_object['memory_stats'].keys():
             mem_usage = json_object['memory_stats']['usage']
             mem_limit = json_object['memory_stats']['limit']
@@ -811,7 +1245,7 @@ def check_containers_memory(ID_list):
         else:
             usage_dict[ID] = mem_usage
             total_usage += mem_usage
-    return ("", [total_usage, usage_dict])
+    return (partial_output(missing), [total_usage, usage_dict])
 
 #END CHECK BLOCK
 
@@ -862,8 +1296,17 @@ def process_usage(checks, value):
         print "container_id_to_usage is"
         print container_id_to_usage
 
+    # Containers without stats (partial result) get no check of their own, and a value of 0
+    # must not stand in for them either
+    if not container_id_to_usage:
+        nagios_exit("No stats came back for any of the containers", check_status.UNKNOWN)
+    for check in checks.keys():
+        if check not in ('total_usage', 'average_usage') and \
+           not [ID for ID in checks[check].container_IDs if ID in container_id_to_usage]:
+            del checks[check]
+
     # Initialize the values of certain labels, values, units of measure.
-    if options.total_usage or options.all:
+    if 'total_usage' in checks:
         checks['total_usage'].setValue(total_usage)
         starting_index += 1
     if options.total_average:
@@ -883,14 +1326,19 @@ def process_usage(checks, value):
 
     # Get additional values
     for check in checks.keys():
+        if check in ('total_usage', 'average_usage'):
+            continue
         labels_long.append(check)
         alias_value = 0
         alias_counter = 0
         for ID in checks[check].container_IDs:
+            if ID not in container_id_to_usage:
+                # No stats (partial result)
+                continue
             if options.networks_use_avg:
                 alias_counter += 1
             alias_value += container_id_to_usage[ID]
-        if options.networks_use_avg and options.networks:
+        if options.networks_use_avg and options.networks and alias_counter:
             alias_value = alias_value/float(alias_counter)
         checks[check].setValue(alias_value)
 
@@ -939,6 +1387,422 @@ def process_usage(checks, value):
 
 #END PROCESS BLOCK
 
+#START CGROUP READER
+
+# The daemon computes its stats from the container's cgroup, so with --cgroup the same counters
+# are read from the cgroup filesystem directly. Paths are those of the cgroupfs and systemd
+# cgroup drivers:
+#   v1: <root>/<controller>/docker/<ID>/, <root>/<controller>/system.slice/docker-<ID>.scope/
+#   v2: <root>/docker/<ID>/, <root>/system.slice/docker-<ID>.scope/
+
+def get_cgroup_version():
+    global cgroup_version
+    if cgroup_version is None:
+        if os.path.exists(os.path.join(options.cgroup_root, "cgroup.controllers")):
+            cgroup_version = 2
+        else:
+            cgroup_version = 1
+    return cgroup_version
+
+# Returns the cgroup directory of the container for controller (ignored on v2), or None
+def find_cgroup_dir(ID, controllers):
+    if get_cgroup_version() == 2:
+        controllers = [""]
+    for controller in controllers:
+        for name in (os.path.join("docker", ID), os.path.join("system.slice", "docker-%s.scope" % ID)):
+            path = os.path.join(options.cgroup_root, controller, name)
+            if os.path.isdir(path):
+                return path
+    return None
+
+def read_cgroup_file(directory, name):
+    f = open(os.path.join(directory, name))
+    try:
+        return f.read().strip()
+    finally:
+        f.close()
+
+# Returns the CPU time the container used so far in nanoseconds, or None
+def read_cgroup_CPU(ID):
+    directory = find_cgroup_dir(ID, ["cpuacct", "cpu,cpuacct"])
+    if not directory:
+        return None
+    try:
+        if get_cgroup_version() == 2:
+            for line in read_cgroup_file(directory, "cpu.stat").splitlines():
+                key, value = line.split()
+                if key == "usage_usec":
+                    return int(value) * 1000
+            return None
+        return int(read_cgroup_file(directory, "cpuacct.usage"))
+    except (IOError, ValueError):
+        return None
+
+# Returns the memory usage and limit of the container in bytes, or None.
+# Unlimited containers get the host's memory as limit, like the daemon reports it.
+def read_cgroup_memory(ID):
+    directory = find_cgroup_dir(ID, ["memory"])
+    if not directory:
+        return None
+    try:
+        if get_cgroup_version() == 2:
+            usage = int(read_cgroup_file(directory, "memory.current"))
+            limit = read_cgroup_file(directory, "memory.max")
+        else:
+            usage = int(read_cgroup_file(directory, "memory.usage_in_bytes"))
+            limit = read_cgroup_file(directory, "memory.limit_in_bytes")
+    except (IOError, ValueError):
+        return None
+    memory_total = host_memory_total()
+    if limit == "max" or (memory_total and int(limit) > memory_total):
+        limit = memory_total
+    return usage, int(limit or 1)
+
+def host_memory_total():
+    global host_memory
+    if host_memory is None:
+        host_memory = 0
+        try:
+            f = open("/proc/meminfo")
+            try:
+                for line in f:
+                    if line.startswith("MemTotal:"):
+                        host_memory = int(line.split()[1]) * 1024
+                        break
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass
+    return host_memory
+
+# get_containers_stats() for --cgroup: builds the subset of the stats API's response the checks
+# use. CPU counters are read twice, --cgroup-interval apart, for all containers together;
+# the system CPU delta is that interval on every online CPU.
+# Running containers without a cgroup are missing, stopped ones get empty stats like from the API.
+def get_cgroup_stats(ID_list):
+    if options.debug: print "hit " + "get_cgroup_stats"
+    stats = dict((ID, container_stats[ID]) for ID in ID_list if ID in container_stats)
+    to_fetch = [ID for ID in ID_list if ID not in container_stats]
+    by_ID = get_container_index()['by_ID']
+    running = [ID for ID in to_fetch if by_ID.get(ID, {}).get('State', "").lower() == "running"]
+    for ID in to_fetch:
+        if ID not in running:
+            stats[ID] = container_stats[ID] = {'cpu_stats': {}, 'precpu_stats': {}, 'memory_stats': {}}
+
+    CPU_before = {}
+    CPU_after = {}
+    if "containers_cpu" in options.check_types:
+        try:
+            CPUs = os.sysconf("SC_NPROCESSORS_ONLN")
+        except (ValueError, OSError):
+            CPUs = 1
+        start = time.time()
+        for ID in running:
+            CPU_before[ID] = read_cgroup_CPU(ID)
+        time.sleep(options.cgroup_interval)
+        system_CPU_delta = int((time.time() - start) * 1e9 * CPUs)
+        # The second reads follow each other as tightly as the first ones, so every container's
+        # interval matches system_CPU_delta. Memory is read after both.
+        for ID in running:
+            if CPU_before[ID] is not None:
+                CPU_after[ID] = read_cgroup_CPU(ID)
+
+    for ID in running:
+        memory = read_cgroup_memory(ID)
+        if memory is None:
+            continue
+        json_object = {'cpu_stats': {}, 'precpu_stats': {},
+                       'memory_stats': {'usage': memory[0], 'limit': memory[1]}}
+        if CPU_after.get(ID) is not None:
+            json_object['precpu_stats'] = {'cpu_usage': {'total_usage': CPU_before[ID]}, 'system_cpu_usage': 0}
+            json_object['cpu_stats'] = {'cpu_usage': {'total_usage': CPU_after[ID]}, 'system_cpu_usage': system_CPU_delta}
+        stats[ID] = container_stats[ID] = json_object
+    missing = [ID for ID in ID_list if ID not in stats]
+    return stats, missing
+
+#END CGROUP READER
+
+#START STATS SAMPLER
+
+# With stream=false the daemon waits for two stats samples, about two seconds, before answering.
+# The sampler (--sampler) instead keeps a streaming stats request open for every running
+# container and remembers its last --sampler-window CPU samples, which --via-sampler checks
+# read over a unix socket without waiting.
+
+# Takes a list of (time, container CPU, system CPU) samples, oldest first, returns a CPU percentage
+def sampler_mean(samples):
+    system_CPU_delta = samples[-1][2] - samples[0][2]
+    if system_CPU_delta <= 0:
+        return 0.0
+    return (samples[-1][1] - samples[0][1]) / float(system_CPU_delta) * 100
+
+def sampler_max(samples):
+    return max([sampler_mean(samples[i:i + 2]) for i in range(len(samples) - 1)])
+
+def sampler_last(samples):
+    return sampler_mean(samples[-2:])
+
+sampler_averages = { "mean": sampler_mean,
+                     "max" : sampler_max,
+                     "last": sampler_last }
+
+# Yields the JSON documents of a streaming response, which Docker sends one per line
+def iter_stream_objects(response):
+    buf = ""
+    while True:
+        if response.chunked:
+            line = response.fp.readline()
+            if not line:
+                return
+            size = int(line.split(";")[0], 16)
+            if size == 0:
+                return
+            data = response.fp.read(size)
+            response.fp.readline() # CRLF after the chunk
+        else:
+            data = response.fp.readline()
+            if not data:
+                return
+        buf += data
+        while "\n" in buf:
+            line, buf = buf.split("\n", 1)
+            if line.strip():
+                yield json.loads(line)
+
+def run_sampler(options):
+    import SocketServer
+
+    samples = {}
+    lock = threading.Lock()
+    samplers = {}
+
+    def sample(ID):
+        connection = new_docker_connection()
+        try:
+            try:
+                connection.request("GET", url_to_path(options.host + "containers/%s/stats?stream=true" % ID))
+                try:
+                    response = connection.getresponse(buffering=True)
+                except TypeError:
+                    # Python 2.6
+                    response = connection.getresponse()
+                if response.status >= 400:
+                    return
+                window = deque(maxlen=options.sampler_window)
+                for stats in iter_stream_objects(response):
+                    CPU_stats = stats.get('cpu_stats', {})
+                    if 'system_cpu_usage' not in CPU_stats:
+                        continue
+                    window.append((time.time(), CPU_stats['cpu_usage']['total_usage'], CPU_stats['system_cpu_usage']))
+                    lock.acquire()
+                    try:
+                        samples[ID] = list(window)
+                    finally:
+                        lock.release()
+            except (httplib.HTTPException, socket.error, ValueError, KeyError):
+                pass
+        finally:
+            # The stream ends when the container stops
+            connection.close()
+            lock.acquire()
+            try:
+                samples.pop(ID, None)
+            finally:
+                lock.release()
+
+    def refresh():
+        while True:
+            containers = talk_to_docker(["containers", "json"], [], False)
+            # Forget the samplers of containers that stopped or are gone
+            running = set(container['Id'] for container in containers or [])
+            for ID in samplers.keys():
+                if not samplers[ID].isAlive() or (containers is not None and ID not in running):
+                    del samplers[ID]
+            for container in containers or []:
+                ID = container['Id']
+                if ID not in samplers or not samplers[ID].isAlive():
+                    samplers[ID] = threading.Thread(target=sample, args=(ID,))
+                    samplers[ID].daemon = True
+                    samplers[ID].start()
+            time.sleep(options.sampler_interval)
+
+    class SamplesHandler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            IDs = json.loads(self.rfile.readline())
+            lock.acquire()
+            try:
+                answer = dict((ID, samples[ID]) for ID in IDs if ID in samples)
+            finally:
+                lock.release()
+            self.wfile.write(json.dumps(answer))
+
+    directory = os.path.dirname(options.sampler_socket)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    if os.path.exists(options.sampler_socket):
+        os.unlink(options.sampler_socket)
+    # Created with its final permissions, so there is no window in which others can connect
+    umask = os.umask(077)
+    try:
+        server = SocketServer.ThreadingUnixStreamServer(options.sampler_socket, SamplesHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+
+    refresher = threading.Thread(target=refresh)
+    refresher.daemon = True
+    refresher.start()
+    # make sure the socket is removed when stopped by an init script
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(options.sampler_socket)
+    sys.exit(0)
+
+# Asks the sampler for the samples of ID_list and returns a dictionary of ID to CPU percentage
+# for the containers it has recent samples of. Returns an empty dictionary if it can't be reached.
+def sampler_CPU_usage(ID_list):
+    if options.debug: print "hit " + "sampler_CPU_usage"
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            # Anyone could have bound a socket at that path while the sampler was down
+            if os.stat(options.sampler_socket).st_uid != os.getuid():
+                raise socket.error("%s is owned by another user" % options.sampler_socket)
+            s.connect(options.sampler_socket)
+            s.sendall(json.dumps(ID_list) + "\n")
+            s.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            answer = json.loads("".join(chunks))
+        except (socket.error, OSError, ValueError), e:
+            if options.debug: print "sampler unavailable: " + str(e)
+            return {}
+    finally:
+        s.close()
+
+    average = sampler_averages[options.sampler_average]
+    oldest = time.time() - options.sampler_max_age
+    usage_dict = {}
+    for ID, window in answer.iteritems():
+        window = [sample for sample in window if sample[0] >= oldest]
+        if len(window) >= 2:
+            usage_dict[ID] = average(window)
+    return usage_dict
+
+#END STATS SAMPLER
+
+#START OPENMETRICS
+
+# --openmetrics-file exports what the checks of this run already fetched, so scrapers don't have
+# to ask the daemon again. --openmetrics-port serves the latest file to scrapers that can't read it.
+
+def openmetrics_escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Returns None for containers without a healthcheck
+def container_health(container):
+    status = container.get('Status', "")
+    if "(healthy)" in status:
+        return 1
+    if "(unhealthy)" in status or "(health: starting)" in status:
+        return 0
+    return None
+
+def make_openmetrics():
+    if options.debug: print "hit " + "make_openmetrics"
+    metrics = [
+        ("docker_container_running", "Whether the container is running.", {}),
+        ("docker_container_healthy", "Whether the container's healthcheck passes.", {}),
+        ("docker_container_cpu_usage_percent", "Share of the host's CPU time used by the container.", {}),
+        ("docker_container_memory_usage_bytes", "Memory used by the container.", {}),
+        ("docker_container_memory_limit_bytes", "Memory the container may use.", {}),
+        ("docker_container_memory_usage_percent", "Memory used by the container, as a share of its limit.", {}),
+    ]
+    samples = dict((name, values) for name, _, values in metrics)
+    labels = {}
+    if container_index is not None:
+        containers = container_index['containers']
+    else:
+        # Not fetched by the checks (cached resolution), and must not fail the check now
+        containers = talk_to_docker(["containers", "json"], ["all=1"], False) or []
+    for container in containers:
+        ID = container['Id']
+        name = (container.get('Names') or [""])[0].lstrip("/")
+        labels[ID] = 'id="%s",name="%s"' % (openmetrics_escape(ID), openmetrics_escape(name))
+        samples["docker_container_running"][ID] = int(container.get('State', "").lower() == "running")
+        health = container_health(container)
+        if health is not None:
+            samples["docker_container_healthy"][ID] = health
+    for ID, percent in CPU_usage.iteritems():
+        samples["docker_container_cpu_usage_percent"][ID] = percent
+    for ID, json_object in container_stats.iteritems():
+        memory = json_object.get('memory_stats', {})
+        if 'usage' in memory and 'limit' in memory:
+            samples["docker_container_memory_usage_bytes"][ID] = memory['usage']
+            samples["docker_container_memory_limit_bytes"][ID] = memory['limit']
+            samples["docker_container_memory_usage_percent"][ID] = memory['usage'] / float(memory['limit'] or 1) * 100
+
+    lines = []
+    for name, help_text, values in metrics:
+        lines.append("# TYPE %s gauge" % name)
+        lines.append("# HELP %s %s" % (name, help_text))
+        for ID in sorted(values.keys()):
+            if ID in labels:
+                lines.append("%s{%s} %s" % (name, labels[ID], repr(float(values[ID]))))
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+def write_openmetrics():
+    if timed_out and container_index is None:
+        # The container list would have to be asked for after the alarm, keep the last export
+        if options.debug: print "timed out, not writing %s" % options.openmetrics_file
+        return
+    try:
+        # Collectors often run as another user
+        write_file_atomically(options.openmetrics_file, make_openmetrics(), 0644)
+    except (IOError, OSError, SystemExit), e:
+        # The check result matters more than the export
+        if options.debug: print "could not write %s: %s" % (options.openmetrics_file, e)
+
+def serve_openmetrics(options):
+    import BaseHTTPServer
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            try:
+                f = open(options.openmetrics_file)
+                try:
+                    body = f.read()
+                finally:
+                    f.close()
+            except IOError:
+                self.send_error(503, "No metrics written yet")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            if options.debug:
+                BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    server = BaseHTTPServer.HTTPServer((options.openmetrics_address, options.openmetrics_port), MetricsHandler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.serve_forever()
+
+#END OPENMETRICS
+
 #START MAIN AND SWITCHES
 
 def do_check(ID_list):
@@ -954,14 +1818,82 @@ def process_value(checks, values):
     (perfdata, exit) = valid_checks[options.check_type][1](checks, values)
     return (perfdata, exit)
 
-def main():
-    options = get_options()
+def run_check(options):
     checks = choose_checks(options)
     ID_list = get_all_container_IDs() if options.all else get_container_IDs(checks)
     (out, values) = do_check(ID_list) # Gives plugin output and a number/dict{str:int}
     (perfdata, exit) = process_value(checks, values) # Gives a complete perfdata string and an exit code
     nagios_exit(out, exit, perfdata)
 
+# Runs one check type and returns (exit code, plugin output) instead of exiting.
+def run_check_captured(check_options):
+    global options
+    from StringIO import StringIO
+    options = check_options
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        try:
+            run_check(check_options)
+            code = check_status.UNKNOWN
+        except SystemExit, e:
+            code = e.code
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    if code not in (0, 1, 2, 3):
+        code = check_status.UNKNOWN
+    return code, output.strip()
+
+# Runs every requested check type against the same container snapshot and stats, then
+# submits one passive result per type.
+def run_multiple_checks(options):
+    results = []
+    for check_type in options.check_types:
+        if timed_out:
+            # The alarm went off during an earlier type and won't go off again
+            code = check_status.UNKNOWN
+            if options.timeout_is_critical:
+                code = check_status.CRITICAL
+            results.append((options.service_prefix + check_type, code, "%s: check timed out" % code_to_status(code)))
+            continue
+        code, output = run_check_captured(options_for_check_type(options, check_type))
+        results.append((options.service_prefix + check_type, code, output.replace("\n", "\\n")))
+
+    worst = max([code for _, code, _ in results])
+    if options.command_file:
+        now = int(time.time())
+        lines = ["[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % (now, options.passive_host, service, code, output)
+                 for service, code, output in results]
+        try:
+            f = open(options.command_file, "a")
+            try:
+                f.write("".join(lines))
+            finally:
+                f.close()
+        except IOError, e:
+            nagios_exit("Could not write to command file %s: %s" % (options.command_file, e), check_status.UNKNOWN)
+        summary = ", ".join(["%s %s" % (service, code_to_status(code)) for service, code, _ in results])
+        nagios_exit("Submitted %d passive check results: %s" % (len(results), summary), worst)
+
+    for service, code, output in results:
+        print "%s\t%s\t%d\t%s" % (options.passive_host, service, code, output)
+    sys.exit(worst)
+
+def main():
+    options = get_options()
+    if options.openmetrics_port:
+        serve_openmetrics(options)
+    if options.sampler:
+        run_sampler(options)
+    try:
+        if options.multiple:
+            run_multiple_checks(options)
+        run_check(options)
+    finally:
+        if options.openmetrics_file:
+            write_openmetrics()
+
 
 valid_checks =  { "containers_exist"    : (check_containers_exist, process_counter),
                   "containers_running"  : (check_containers_running, process_counter),
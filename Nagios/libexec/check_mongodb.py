@@ -45,25 +45,22 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import sys
 import time
+STARTED = time.time()
+
+import sys
 import optparse
-import textwrap
-import re
 import os
 
-try:
-    import pymongo
-except ImportError, e:
-    print e
-    sys.exit(2)
+# pymongo and son are imported by import_pymongo() once the options are parsed
+pymongo = None
+son = None
 
-# As of pymongo v 1.9 the SON API is part of the BSON package, therefore attempt
-# to import from there and fall back to pymongo in cases of older pymongo
-if pymongo.version >= "1.9":
-    import bson.son as son
-else:
-    import pymongo.son as son
+# serverStatus documents shared by several actions in the same run, keyed by connection
+server_status_cache = {}
+
+# ((pid, file name), connection) of the delta state store, opened once per process
+state_store = None
 
 
 #
@@ -133,7 +130,29 @@ def check_levels(param, warning, critical, message, ok=[]):
         return 2
 
 
+def import_pymongo():
+    global pymongo, son
+    try:
+        import pymongo
+    except ImportError, e:
+        print e
+        sys.exit(2)
+
+    # As of pymongo v 1.9 the SON API is part of the BSON package, therefore attempt
+    # to import from there and fall back to pymongo in cases of older pymongo
+    if pymongo.version >= "1.9":
+        import bson.son as son
+    else:
+        import pymongo.son as son
+
+
+def print_startup_profile(profile):
+    sys.stderr.write("Startup profile: %s\n" % ", ".join(["%s=%.3fs" % step for step in profile]))
+
+
 def get_server_status(con):
+    if id(con) in server_status_cache:
+        return server_status_cache[id(con)]
     try:
         set_read_preference(con.admin)
         data = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
@@ -151,16 +170,20 @@ def main(argv):
     p.add_option('-p', '--pass', action='store', type='string', dest='passwd', default=None, help='The password you want to use for that user')
     p.add_option('-W', '--warning', action='store', dest='warning', default=None, help='The warning threshold you want to set')
     p.add_option('-C', '--critical', action='store', dest='critical', default=None, help='The critical threshold you want to set')
-    p.add_option('-A', '--action', action='store', type='choice', dest='action', default='connect', help='The action you want to take',
-                 choices=['connect', 'connections', 'replication_lag', 'replication_lag_percent', 'replset_state', 'memory', 'memory_mapped', 'lock',
-                          'flushing', 'last_flush_time', 'index_miss_ratio', 'databases', 'collections', 'database_size', 'database_indexes', 'collection_indexes', 'collection_size',
-                          'collection_storageSize', 'queues', 'oplog', 'journal_commits_in_wl', 'write_data_files', 'journaled', 'opcounters', 'current_lock', 'replica_primary',
-                          'page_faults', 'asserts', 'queries_per_second', 'page_faults', 'chunks_balance', 'connect_primary', 'collection_state', 'row_count', 'replset_quorum'])
+    p.add_option('-A', '--action', action='store', type='string', dest='action', default='connect',
+                 help='The action you want to take. Pass a comma separated list to run several actions against one serverStatus call ' \
+                      'and emit one passive check result per action. Each action of a list takes its own thresholds as action:warning:critical, ' \
+                      'e.g. connections:80:95,queues:10:20 (separate the states of replset_state with /)')
     p.add_option('--max-lag', action='store_true', dest='max_lag', default=False, help='Get max replication lag (for replication_lag action only)')
     p.add_option('--mapped-memory', action='store_true', dest='mapped_memory', default=False, help='Get mapped memory instead of resident (if resident memory can not be read)')
     p.add_option('-D', '--perf-data', action='store_true', dest='perf_data', default=False, help='Enable output of Nagios performance data')
     p.add_option('-d', '--database', action='store', dest='database', default='admin', help='Specify the database to check')
-    p.add_option('--all-databases', action='store_true', dest='all_databases', default=False, help='Check all databases (action database_size)')
+    p.add_option('--all-databases', action='store_true', dest='all_databases', default=False, help='Check all databases (action database_size) or all sharded namespaces (action chunks_balance)')
+    p.add_option('--concurrency', action='store', type='int', dest='concurrency', default=8, help='Number of databases queried in parallel (collections and database_size --all-databases)')
+    p.add_option('--total-deadline', action='store', type='float', dest='total_deadline', default=50,
+                 help='Seconds after which databases that did not answer yet are reported as a partial result (collections and database_size --all-databases)')
+    p.add_option('--call-deadline', action='store', type='float', dest='call_deadline', default=10,
+                 help='Seconds to wait for a single database before reporting a partial result (collections and database_size --all-databases)')
     p.add_option('-s', '--ssl', dest='ssl', default=False, action='callback', callback=optional_arg(True), help='Connect using SSL')
     p.add_option('-r', '--replicaset', dest='replicaset', default=None, action='callback', callback=optional_arg(True), help='Connect to replicaset')
     p.add_option('-q', '--querytype', action='store', dest='query_type', default='query', help='The query type to check [query|insert|update|delete|getmore|command] from queries_per_second')
@@ -171,44 +194,81 @@ def main(argv):
     p.add_option('-a', '--authdb', action='store', type='string', dest='authdb', default='admin', help='The database you want to authenticate against')
     p.add_option('--insecure', action='store_true', dest='insecure', default=False, help="Don't verify SSL/TLS certificates")
     p.add_option('-f', '--ssl-cert-file', action='store', type='string', dest='cert_file', default=None, help='Path to PEM encoded key and cert for client authentication')
+    p.add_option('--passive-host', action='store', type='string', dest='passive_host', default=None, help='Host name used in passive check results (multiple actions only, defaults to --host)')
+    p.add_option('--service-prefix', action='store', type='string', dest='service_prefix', default='', help='Prefix prepended to the action name to build the service description of passive check results (multiple actions only)')
+    p.add_option('--command-file', action='store', type='string', dest='command_file', default=None,
+                 help='Write passive check results to this Nagios command file instead of printing them in send_nsca format (multiple actions only)')
+    p.add_option('--collector', action='store_true', dest='collector', default=False, help='Run as a collector keeping snapshots of --collector-hosts for --via-collector checks')
+    p.add_option('--collector-hosts', action='store', type='string', dest='collector_hosts', default=None, help='Comma separated list of host[:port] to collect (collector only, defaults to --host)')
+    p.add_option('--collector-socket', action='store', type='string', dest='collector_socket', default='~/.check_mongodb/collector.sock', help='The unix socket the collector listens on, in a directory only its user can write to. Checks refuse a socket owned by another user')
+    p.add_option('--collector-interval', action='store', type='int', dest='collector_interval', default=30, help='Seconds between two snapshots of a host (collector only)')
+    p.add_option('--via-collector', action='store_true', dest='via_collector', default=False, help='Read the snapshot of --host from the collector instead of connecting to mongodb')
+    p.add_option('--profile-startup', action='store_true', dest='profile_startup', default=False, help='Report import, connect and action timings on stderr')
+    p.add_option('--collector-max-age', action='store', type='int', dest='collector_max_age', default=300, help='Return UNKNOWN if the collector snapshot is older than this many seconds')
 
     options, arguments = p.parse_args()
+    options.collector_socket = os.path.expanduser(options.collector_socket)
+
+    profile = [("module", time.time() - STARTED)]
+    try:
+        return run_main(p, options, profile)
+    finally:
+        if options.profile_startup:
+            print_startup_profile(profile)
+
+
+def run_main(p, options, profile):
+    started = time.time()
+    import_pymongo()
+    profile.append(("import_pymongo", time.time() - started))
+
     host = options.host
     port = options.port
     user = options.user
     passwd = options.passwd
     authdb = options.authdb
 
-    query_type = options.query_type
-    collection = options.collection
-    sample_time = options.sample_time
-    if (options.action == 'replset_state'):
-        warning = str(options.warning or "")
-        critical = str(options.critical or "")
-    else:
-        warning = float(options.warning or 0)
-        critical = float(options.critical or 0)
-
-    action = options.action
-    perf_data = options.perf_data
-    max_lag = options.max_lag
-    mongo_version = options.mongo_version
-    database = options.database
+    if options.collector:
+        return run_collector(options)
+
+    actions = []
+    thresholds = {}
+    for entry in [a.strip() for a in options.action.split(',') if a.strip()]:
+        fields = entry.split(':')
+        action = fields[0]
+        if action not in ACTIONS:
+            p.error("option -A: invalid choice: '%s' (choose from %s)" % (action, ", ".join(["'%s'" % a for a in sorted(ACTIONS)])))
+        if len(fields) > 3:
+            p.error("option -A: '%s' is not action[:warning[:critical]]" % entry)
+        fields += [None, None]
+        thresholds[action] = (fields[1] and fields[1].replace('/', ','), fields[2] and fields[2].replace('/', ','))
+        actions.append(action)
+    if not actions:
+        p.error("option -A: no action given")
+    if len(actions) == 1:
+        if thresholds[actions[0]] != (None, None):
+            options.warning, options.critical = thresholds[actions[0]]
+    elif options.warning is not None or options.critical is not None:
+        p.error("options -W and -C: give the thresholds of several actions as -A action:warning:critical")
+
     ssl = options.ssl
     replicaset = options.replicaset
     insecure = options.insecure
     cert_file = options.cert_file
 
-    if action == 'replica_primary' and replicaset is None:
+    if 'replica_primary' in actions and replicaset is None:
         return "replicaset must be passed in when using replica_primary check"
-    elif not action == 'replica_primary' and replicaset:
+    elif not 'replica_primary' in actions and replicaset:
         return "passing a replicaset while not checking replica_primary does not work"
 
     #
     # moving the login up here and passing in the connection
     #
     start = time.time()
-    err, con = mongo_connect(host, port, ssl, user, passwd, replicaset, authdb, insecure, cert_file)
+    if options.via_collector:
+        err, con = collector_connect(options)
+    else:
+        err, con = mongo_connect(host, port, ssl, user, passwd, replicaset, authdb, insecure, cert_file)
 
     if err != 0:
         return err
@@ -219,89 +279,162 @@ def main(argv):
         return err
 
     conn_time = time.time() - start
+    profile.append(("connect", conn_time))
     conn_time = round(conn_time, 0)
 
-    if action == "connections":
-        return check_connections(con, warning, critical, perf_data)
-    elif action == "replication_lag":
-        return check_rep_lag(con, host, warning, critical, False, perf_data, max_lag, user, passwd)
-    elif action == "replication_lag_percent":
-        return check_rep_lag(con, host, warning, critical, True, perf_data, max_lag, user, passwd, ssl, insecure, cert_file)
-    elif action == "replset_state":
-        return check_replset_state(con, perf_data, warning, critical)
-    elif action == "memory":
-        return check_memory(con, warning, critical, perf_data, options.mapped_memory, host)
-    elif action == "memory_mapped":
-        return check_memory_mapped(con, warning, critical, perf_data)
-    elif action == "queues":
-        return check_queues(con, warning, critical, perf_data)
-    elif action == "lock":
-        return check_lock(con, warning, critical, perf_data, mongo_version)
-    elif action == "current_lock":
-        return check_current_lock(con, host, port, warning, critical, perf_data)
-    elif action == "flushing":
-        return check_flushing(con, warning, critical, True, perf_data)
-    elif action == "last_flush_time":
-        return check_flushing(con, warning, critical, False, perf_data)
-    elif action == "index_miss_ratio":
-        index_miss_ratio(con, warning, critical, perf_data)
-    elif action == "databases":
-        return check_databases(con, warning, critical, perf_data)
-    elif action == "collections":
-        return check_collections(con, warning, critical, perf_data)
-    elif action == "oplog":
-        return check_oplog(con, warning, critical, perf_data)
-    elif action == "journal_commits_in_wl":
-        return check_journal_commits_in_wl(con, warning, critical, perf_data)
-    elif action == "database_size":
-        if options.all_databases:
-            return check_all_databases_size(con, warning, critical, perf_data)
-        else:
-            return check_database_size(con, database, warning, critical, perf_data)
-    elif action == "database_indexes":
-        return check_database_indexes(con, database, warning, critical, perf_data)
-    elif action == "collection_indexes":
-        return check_collection_indexes(con, database, collection, warning, critical, perf_data)
-    elif action == "collection_size":
-        return check_collection_size(con, database, collection, warning, critical, perf_data)
-    elif action == "collection_storageSize":
-        return check_collection_storageSize(con, database, collection, warning, critical, perf_data)
-    elif action == "journaled":
-        return check_journaled(con, warning, critical, perf_data)
-    elif action == "write_data_files":
-        return check_write_to_datafiles(con, warning, critical, perf_data)
-    elif action == "opcounters":
-        return check_opcounters(con, host, port, warning, critical, perf_data)
-    elif action == "asserts":
-        return check_asserts(con, host, port, warning, critical, perf_data)
-    elif action == "replica_primary":
-        return check_replica_primary(con, host, warning, critical, perf_data, replicaset, mongo_version)
-    elif action == "queries_per_second":
-        return check_queries_per_second(con, query_type, warning, critical, perf_data, mongo_version)
-    elif action == "page_faults":
-        check_page_faults(con, sample_time, warning, critical, perf_data)
-    elif action == "chunks_balance":
-        chunks_balance(con, database, collection, warning, critical)
-    elif action == "connect_primary":
-        return check_connect_primary(con, warning, critical, perf_data)
-    elif action == "collection_state":
-        return check_collection_state(con, database, collection)
-    elif action == "row_count":
-        return check_row_count(con, database, collection, warning, critical, perf_data)
-    elif action == "replset_quorum":
-        return check_replset_quorum(con, perf_data)
+    started = time.time()
+    try:
+        if len(actions) == 1:
+            return run_action(con, actions[0], options, mongo_version, conn_time)
+
+        return run_multiple_actions(con, actions, thresholds, options, mongo_version, conn_time)
+    finally:
+        profile.append(("action", time.time() - started))
+
+
+#
+# Action registry: every action maps to a handler called as
+# handler(con, options, warning, critical, mongo_version, conn_time)
+#
+ACTIONS = {
+    'connect': lambda con, o, w, c, v, t: check_connect(o.host, o.port, w, c, o.perf_data, o.user, o.passwd, t),
+    'connections': lambda con, o, w, c, v, t: check_connections(con, w, c, o.perf_data),
+    'replication_lag': lambda con, o, w, c, v, t: check_rep_lag(con, o.host, w, c, False, o.perf_data, o.max_lag, o.user, o.passwd),
+    'replication_lag_percent': lambda con, o, w, c, v, t: check_rep_lag(con, o.host, w, c, True, o.perf_data, o.max_lag, o.user, o.passwd, o.ssl, o.insecure, o.cert_file),
+    'replication_lag_cluster': lambda con, o, w, c, v, t: check_rep_lag_cluster(con, o.host, o.port, w, c, False, o.perf_data),
+    'replication_lag_cluster_percent': lambda con, o, w, c, v, t: check_rep_lag_cluster(con, o.host, o.port, w, c, True, o.perf_data, o.user, o.passwd, o.ssl, o.insecure, o.cert_file),
+    'replset_state': lambda con, o, w, c, v, t: check_replset_state(con, o.perf_data, w, c),
+    'memory': lambda con, o, w, c, v, t: check_memory(con, w, c, o.perf_data, o.mapped_memory, o.host),
+    'memory_mapped': lambda con, o, w, c, v, t: check_memory_mapped(con, w, c, o.perf_data),
+    'queues': lambda con, o, w, c, v, t: check_queues(con, w, c, o.perf_data),
+    'lock': lambda con, o, w, c, v, t: check_lock(con, w, c, o.perf_data, v),
+    'current_lock': lambda con, o, w, c, v, t: check_current_lock(con, o.host, o.port, w, c, o.perf_data),
+    'flushing': lambda con, o, w, c, v, t: check_flushing(con, w, c, True, o.perf_data),
+    'last_flush_time': lambda con, o, w, c, v, t: check_flushing(con, w, c, False, o.perf_data),
+    'index_miss_ratio': lambda con, o, w, c, v, t: index_miss_ratio(con, w, c, o.perf_data),
+    'databases': lambda con, o, w, c, v, t: check_databases(con, w, c, o.perf_data),
+    'collections': lambda con, o, w, c, v, t: check_collections(con, w, c, o.perf_data, o.concurrency, o.call_deadline, o.total_deadline),
+    'oplog': lambda con, o, w, c, v, t: check_oplog(con, o.host, o.port, w, c, o.perf_data),
+    'journal_commits_in_wl': lambda con, o, w, c, v, t: check_journal_commits_in_wl(con, w, c, o.perf_data),
+    'database_size': lambda con, o, w, c, v, t: check_all_databases_size(con, w, c, o.perf_data, o.concurrency, o.call_deadline, o.total_deadline) if o.all_databases \
+                                                else check_database_size(con, o.database, w, c, o.perf_data),
+    'database_indexes': lambda con, o, w, c, v, t: check_database_indexes(con, o.database, w, c, o.perf_data),
+    'collection_indexes': lambda con, o, w, c, v, t: check_collection_indexes(con, o.database, o.collection, w, c, o.perf_data),
+    'collection_size': lambda con, o, w, c, v, t: check_collection_size(con, o.database, o.collection, w, c, o.perf_data),
+    'collection_storageSize': lambda con, o, w, c, v, t: check_collection_storageSize(con, o.database, o.collection, w, c, o.perf_data),
+    'journaled': lambda con, o, w, c, v, t: check_journaled(con, w, c, o.perf_data),
+    'write_data_files': lambda con, o, w, c, v, t: check_write_to_datafiles(con, w, c, o.perf_data),
+    'opcounters': lambda con, o, w, c, v, t: check_opcounters(con, o.host, o.port, w, c, o.perf_data),
+    'asserts': lambda con, o, w, c, v, t: check_asserts(con, o.host, o.port, w, c, o.perf_data),
+    'replica_primary': lambda con, o, w, c, v, t: check_replica_primary(con, o.host, w, c, o.perf_data, o.replicaset, v),
+    'queries_per_second': lambda con, o, w, c, v, t: check_queries_per_second(con, o.host, o.port, o.query_type, w, c, o.perf_data),
+    'page_faults': lambda con, o, w, c, v, t: check_page_faults(con, o.sample_time, w, c, o.perf_data),
+    'chunks_balance': lambda con, o, w, c, v, t: chunks_balance(con, o.database, o.collection, w, c, o.perf_data, o.all_databases),
+    'connect_primary': lambda con, o, w, c, v, t: check_connect_primary(con, w, c, o.perf_data),
+    'collection_state': lambda con, o, w, c, v, t: check_collection_state(con, o.database, o.collection),
+    'row_count': lambda con, o, w, c, v, t: check_row_count(con, o.database, o.collection, w, c, o.perf_data),
+    'replset_quorum': lambda con, o, w, c, v, t: check_replset_quorum(con, o.perf_data),
+}
+
+
+def run_action(con, action, options, mongo_version, conn_time, thresholds=None):
+    if options.via_collector and action in COLLECTOR_UNSUPPORTED_ACTIONS:
+        print "UNKNOWN - Action %s needs a direct connection and can't be answered from the collector" % action
+        return 3
+
+    warning, critical = thresholds or (options.warning, options.critical)
+    if (action == 'replset_state'):
+        warning = str(warning or "")
+        critical = str(critical or "")
     else:
-        return check_connect(host, port, warning, critical, perf_data, user, passwd, conn_time)
+        warning = float(warning or 0)
+        critical = float(critical or 0)
+
+    return ACTIONS[action](con, options, warning, critical, mongo_version, conn_time)
+
+
+# Actions that need more than the serverStatus, isMaster, replSetGetStatus, replica set config,
+# listDatabases and dbstats documents kept by the collector (collstats, the oplog, other
+# collections, several samples or a connection to another member)
+COLLECTOR_UNSUPPORTED_ACTIONS = set([
+    'replication_lag_percent', 'replication_lag_cluster_percent', 'collections', 'oplog',
+    'collection_indexes', 'collection_size', 'collection_storageSize', 'replica_primary',
+    'page_faults', 'chunks_balance', 'connect_primary', 'collection_state', 'row_count',
+])
+
+
+def run_action_captured(con, action, options, mongo_version, conn_time, thresholds=None):
+    """ Run a single action and return its (return code, output) instead of printing and exiting """
+    import StringIO
+
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        try:
+            code = run_action(con, action, options, mongo_version, conn_time, thresholds)
+        except SystemExit, e:
+            code = e.code
+        except Exception, e:
+            code = exit_with_general_critical(e)
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+    if isinstance(code, SystemExit):
+        code = code.code
+    if code is None:
+        code = 0
+    elif not isinstance(code, int):
+        # sys.exit() with a message, the message is the output
+        output = output or str(code)
+        code = 3
+    return code, output.strip().replace("\n", " ")
+
+
+def run_multiple_actions(con, actions, thresholds, options, mongo_version, conn_time):
+    """ Answer several actions from one connection and one serverStatus call.
+    Every action is checked against its own (warning, critical) from thresholds, missing ones use the action's defaults.
+    One passive check result is emitted per action, either in send_nsca format
+    on stdout or as PROCESS_SERVICE_CHECK_RESULT commands in the Nagios command file."""
+    try:
+        server_status_cache[id(con)] = get_server_status(con)
+    except Exception, e:
+        return exit_with_general_critical(e)
+
+    passive_host = options.passive_host or options.host
+    results = []
+    for action in actions:
+        code, output = run_action_captured(con, action, options, mongo_version, conn_time, thresholds[action])
+        results.append((options.service_prefix + action, code, output))
+
+    worst = max([code for service, code, output in results])
+    if options.command_file:
+        now = int(time.time())
+        try:
+            f = open(options.command_file, 'a')
+            for service, code, output in results:
+                f.write("[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % (now, passive_host, service, code, output))
+            f.close()
+        except IOError, e:
+            print "UNKNOWN - Can't write to command file %s: %s" % (options.command_file, e)
+            return 3
+        states = ["OK", "WARNING", "CRITICAL", "UNKNOWN"]
+        print "%s - Submitted %d passive check results: %s" % (states[min(worst, 3)], len(results),
+            ", ".join(["%s=%s" % (service, states[min(code, 3)]) for service, code, output in results]))
+    else:
+        for service, code, output in results:
+            print "%s\t%s\t%d\t%s" % (passive_host, service, code, output)
+    return worst
 
 
 def mongo_connect(host=None, port=None, ssl=False, user=None, passwd=None, replica=None, authdb="admin", insecure=False, ssl_cert=None):
     from pymongo.errors import ConnectionFailure
     from pymongo.errors import PyMongoError
-    import ssl as SSL
 
     con_args = dict()
 
     if ssl:
+        import ssl as SSL
         if insecure:
             con_args['ssl_cert_reqs'] = SSL.CERT_NONE
         else:
@@ -373,6 +506,128 @@ def set_read_preference(db):
     else:
         db.read_preference = pymongo.ReadPreference.SECONDARY
 
+def fan_out(func, items, concurrency, deadline, total_deadline=None):
+    """ Call func(item) for every item on a pool of concurrency threads.
+    A call still running after deadline seconds is abandoned and reported as failed. Its thread
+    rejoins the pool once the call returns, and a replacement is only started while fewer than
+    twice concurrency threads are alive, so stuck calls can't multiply the load on the server.
+    Items not answered after total_deadline seconds are reported as failed as well, and so are
+    calls that raise a timeout error. Any other error is raised once every call is done.
+    Returns the results keyed by item and the items that timed out, in input order"""
+    import threading
+    import Queue
+
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    results = {}
+    failed = {}
+    errors = {}
+    running = {}
+    alive = [0]
+    lock = threading.Lock()
+    max_threads = 2 * concurrency
+
+    def worker():
+        me = threading.current_thread()
+        try:
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                lock.acquire()
+                running[me] = (item, time.time())
+                lock.release()
+                try:
+                    result, error = func(item), None
+                except Exception, e:
+                    result, error = None, e
+                lock.acquire()
+                try:
+                    if running.pop(me, None) is None:
+                        # abandoned after its deadline, the item is already reported
+                        continue
+                    if error is None:
+                        results[item] = result
+                    elif is_timeout(error):
+                        failed[item] = error
+                    else:
+                        errors[item] = error
+                finally:
+                    lock.release()
+        finally:
+            lock.acquire()
+            alive[0] -= 1
+            lock.release()
+
+    def start_worker():
+        alive[0] += 1
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    lock.acquire()
+    try:
+        for i in range(min(concurrency, len(items))):
+            start_worker()
+    finally:
+        lock.release()
+
+    started = time.time()
+    while True:
+        lock.acquire()
+        try:
+            now = time.time()
+            for t, (item, call_started) in running.items():
+                if now - call_started > deadline:
+                    del running[t]
+                    failed[item] = "no answer after %s seconds" % deadline
+                    if alive[0] < max_threads and not pending.empty():
+                        start_worker()
+            if total_deadline is not None and now - started > total_deadline:
+                for item in items:
+                    if item not in results and item not in failed and item not in errors:
+                        failed[item] = "no answer after %s seconds overall" % total_deadline
+                running.clear()
+                # let the workers that are still alive stop at their next item
+                while not pending.empty():
+                    try:
+                        pending.get_nowait()
+                    except Queue.Empty:
+                        break
+            if len(results) + len(failed) + len(errors) == len(items):
+                break
+        finally:
+            lock.release()
+        time.sleep(0.01)
+
+    for item in items:
+        if item in errors:
+            raise errors[item]
+    return results, [item for item in items if item in failed]
+
+
+def is_timeout(error):
+    """ Whether error is mongod giving up at maxTimeMS or the connection timing out """
+    timeouts = tuple([getattr(pymongo.errors, name) for name in ('ExecutionTimeout', 'NetworkTimeout') if hasattr(pymongo.errors, name)])
+    if timeouts and isinstance(error, timeouts):
+        return True
+    # ExceededTimeLimit, for pymongo versions without ExecutionTimeout
+    return getattr(error, 'code', None) == 50
+
+
+def no_answer(missing):
+    print "UNKNOWN - No database answered in time: %s" % ", ".join(missing)
+    return 3
+
+
+def partial_message(missing):
+    if not missing:
+        return ""
+    return " (partial result, no answer from: %s)" % ", ".join(missing)
+
+
 def check_version(con):
     try:
         server_info = con.server_info()
@@ -486,10 +741,9 @@ def check_rep_lag(con, host, warning, critical, percent, perf_data, max_lag, use
                             data = data + member['name'] + " lag=%d;" % replicationLag
                             maximal_lag = max(maximal_lag, replicationLag)
                     if percent:
-                        err, con = mongo_connect(primary_node['name'].split(':')[0], int(primary_node['name'].split(':')[1]), False, user, passwd)
+                        err, primary_timediff = get_primary_oplog_window(primary_node['name'], False, user, passwd)
                         if err != 0:
                             return err
-                        primary_timediff = replication_get_time_diff(con)
                         maximal_lag = int(float(maximal_lag) / float(primary_timediff) * 100)
                         message = "Maximal lag is " + str(maximal_lag) + " percents"
                         message += performance_data(perf_data, [(maximal_lag, "replication_lag_percent", warning, critical)])
@@ -518,10 +772,9 @@ def check_rep_lag(con, host, warning, critical, percent, perf_data, max_lag, use
                 lag = float(optime_lag.seconds + optime_lag.days * 24 * 3600)
 
             if percent:
-                err, con = mongo_connect(primary_node['name'].split(':')[0], int(primary_node['name'].split(':')[1]), ssl, user, passwd, None, None, insecure, cert_file)
+                err, primary_timediff = get_primary_oplog_window(primary_node['name'], ssl, user, passwd, None, None, insecure, cert_file)
                 if err != 0:
                     return err
-                primary_timediff = replication_get_time_diff(con)
                 if primary_timediff != 0:
                     lag = int(float(lag) / float(primary_timediff) * 100)
                 else:
@@ -562,10 +815,9 @@ def check_rep_lag(con, host, warning, critical, percent, perf_data, max_lag, use
             optime_lag = abs(primary_node[1] - host_node["optimeDate"])
             lag = optime_lag.seconds
             if percent:
-                err, con = mongo_connect(primary_node['name'].split(':')[0], int(primary_node['name'].split(':')[1]))
+                err, primary_timediff = get_primary_oplog_window(primary_node[0])
                 if err != 0:
                     return err
-                primary_timediff = replication_get_time_diff(con)
                 lag = int(float(lag) / float(primary_timediff) * 100)
                 message = "Lag is " + str(lag) + " percents"
                 message += performance_data(perf_data, [(lag, "replication_lag_percent", warning, critical)])
@@ -577,6 +829,89 @@ def check_rep_lag(con, host, warning, critical, percent, perf_data, max_lag, use
     except Exception, e:
         return exit_with_general_critical(e)
 
+def check_rep_lag_cluster(con, host, port, warning, critical, percent, perf_data, user=None, passwd=None, ssl=None, insecure=None, cert_file=None):
+    """ Replication lag of every member of the replica set from a single replSetGetStatus,
+    against the primary optime and the slaveDelay of the member. Percentages are of the oplog
+    window of the primary, which is connected to when it is not the host checked"""
+    if percent:
+        warning = warning or 50
+        critical = critical or 75
+    else:
+        warning = warning or 600
+        critical = critical or 3600
+    try:
+        try:
+            rs_status = con.admin.command("replSetGetStatus")
+        except pymongo.errors.OperationFailure, e:
+            if ((e.code == None and str(e).find('failed: not running with --replSet"')) or (e.code == 76 and str(e).find('not running with --replSet"'))):
+                print "OK - Not running with replSet"
+                return 0
+            raise
+
+        slaveDelays = {}
+        rs_conf = con.local.system.replset.find_one()
+        for member in rs_conf['members']:
+            slaveDelays[member['host']] = member.get('slaveDelay') or 0
+
+        primary_node = None
+        for member in rs_status['members']:
+            if member['stateStr'] == "PRIMARY":
+                primary_node = member
+
+        if primary_node is None:
+            print "WARNING - No primary defined. In an election?"
+            return 1
+
+        if percent:
+            if primary_node.get('self'):
+                oplog_window = get_oplog_window(con, host, port)
+            else:
+                err, oplog_window = get_primary_oplog_window(primary_node['name'], ssl, user, passwd, None, None, insecure, cert_file)
+                if err != 0:
+                    return err
+
+        lags = []
+        no_optime = []
+        for member in rs_status['members']:
+            if member['stateStr'] in ("PRIMARY", "ARBITER"):
+                continue
+            if not 'optimeDate' in member:
+                no_optime.append(member['name'])
+                continue
+            lag = timedelta_seconds(primary_node['optimeDate'] - member['optimeDate']) - slaveDelays.get(member['name'], 0)
+            lag = max(lag, 0)
+            if percent:
+                if oplog_window != 0:
+                    lag = int(float(lag) / float(oplog_window) * 100)
+                else:
+                    lag = 0
+            lags.append((lag, member['name']))
+
+        if not lags:
+            print "OK - No secondaries to check"
+            return 0
+
+        maximal_lag, worst_member = max(lags)
+        unit = percent and "percents" or "seconds"
+        message = "Maximal lag is %s %s (%s), %d members checked" % (maximal_lag, unit, worst_member, len(lags))
+        if no_optime:
+            message += ", no optime for " + ", ".join(no_optime)
+        label = percent and "replication_lag_percent" or "replication_lag"
+        message += performance_data(perf_data, [(maximal_lag, label, warning, critical)] +
+                    [(lag, "%s_%s" % (name, label), warning, critical) for lag, name in lags])
+        return check_levels(maximal_lag, warning, critical, message)
+
+    except Exception, e:
+        return exit_with_general_critical(e)
+
+
+def timedelta_seconds(td):
+    try:  # work starting from python2.7
+        return td.total_seconds()
+    except:
+        return float(td.seconds + td.days * 24 * 3600)
+
+
 #
 # Check the memory usage of mongo. Alerting on this may be hard to get right
 # because it'll try to get as much memory as it can. And that's probably
@@ -586,6 +921,8 @@ def check_memory(con, warning, critical, perf_data, mapped_memory, host):
     # Get the total system memory of this system (This is totally bogus if you
     # are running this command remotely) and calculate based on that how much
     # memory used by Mongodb is ok or not.
+    import re
+
     meminfo = open('/proc/meminfo').read()
     matched = re.search(r'^MemTotal:\s+(\d+)', meminfo)
     if matched:
@@ -873,7 +1210,7 @@ def check_databases(con, warning, critical, perf_data=None):
         return exit_with_general_critical(e)
 
 
-def check_collections(con, warning, critical, perf_data=None):
+def check_collections(con, warning, critical, perf_data=None, concurrency=8, deadline=10, total_deadline=None):
     try:
         try:
             set_read_preference(con.admin)
@@ -881,13 +1218,18 @@ def check_collections(con, warning, critical, perf_data=None):
         except:
             data = con.admin.command(son.SON([('listDatabases', 1)]))
 
-        count = 0
-        for db in data['databases']:
-            dbase = con[db['name']]
+        def count_collections(database):
+            dbase = con[database]
             set_read_preference(dbase)
-            count += len(dbase.collection_names())
+            return len(dbase.collection_names())
 
-        message = "Number of collections: %.0f" % count
+        databases = sorted([db['name'] for db in data['databases']])
+        counts, missing = fan_out(count_collections, databases, concurrency, deadline, total_deadline)
+        if databases and not counts:
+            return no_answer(missing)
+        count = sum(counts.values())
+
+        message = "Number of collections: %.0f" % count + partial_message(missing)
         message += performance_data(perf_data, [(count, "collections", warning, critical, message)])
         return check_levels(count, warning, critical, message)
 
@@ -895,7 +1237,7 @@ def check_collections(con, warning, critical, perf_data=None):
         return exit_with_general_critical(e)
 
 
-def check_all_databases_size(con, warning, critical, perf_data):
+def check_all_databases_size(con, warning, critical, perf_data, concurrency=8, deadline=10, total_deadline=None):
     warning = warning or 100
     critical = critical or 1000
     try:
@@ -904,18 +1246,25 @@ def check_all_databases_size(con, warning, critical, perf_data):
     except:
         all_dbs_data = con.admin.command(son.SON([('listDatabases', 1)]))
 
+    databases = sorted([db['name'] for db in all_dbs_data['databases']])
+    # maxTimeMS makes mongod itself give up on a dbstats the fan-out stopped waiting for
+    stats, missing = fan_out(lambda database: con[database].command('dbstats', maxTimeMS=int(deadline * 1000)), databases, concurrency, deadline, total_deadline)
+    if databases and not stats:
+        return no_answer(missing)
+
     total_storage_size = 0
     message = ""
     perf_data_param = [()]
-    for db in all_dbs_data['databases']:
-        database = db['name']
-        data = con[database].command('dbstats')
-        storage_size = round(data['storageSize'] / 1024 / 1024, 1)
+    for database in databases:
+        if database not in stats:
+            continue
+        storage_size = round(stats[database]['storageSize'] / 1024 / 1024, 1)
         message += "; Database %s size: %.0f MB" % (database, storage_size)
         perf_data_param.append((storage_size, database + "_database_size"))
         total_storage_size += storage_size
 
     perf_data_param[0] = (total_storage_size, "total_size", warning, critical)
+    message += partial_message(missing)
     message += performance_data(perf_data, perf_data_param)
     message = "Total size: %.0f MB" % total_storage_size + message
     return check_levels(total_storage_size, warning, critical, message)
@@ -1064,68 +1413,48 @@ def check_collection_storageSize(con, database, collection, warning, critical, p
         return exit_with_general_critical(e)
 
 
-def check_queries_per_second(con, query_type, warning, critical, perf_data, mongo_version):
+def check_queries_per_second(con, host, port, query_type, warning, critical, perf_data):
+    """ Per second rate of the opcounters, the previous counters are kept in the local state store
+    so nothing is written to the monitored server"""
     warning = warning or 250
     critical = critical or 500
 
-    if query_type not in ['insert', 'query', 'update', 'delete', 'getmore', 'command']:
+    query_types = ['insert', 'query', 'update', 'delete', 'getmore', 'command']
+    if query_type not in query_types:
         return exit_with_general_critical("The query type of '%s' is not valid" % query_type)
 
     try:
-        db = con.local
         data = get_server_status(con)
 
-        # grab the count
-        num = int(data['opcounters'][query_type])
-
-        # do the math
-        last_count = db.nagios_check.find_one({'check': 'query_counts'})
-        try:
-            ts = int(time.time())
-            diff_query = num - last_count['data'][query_type]['count']
-            diff_ts = ts - last_count['data'][query_type]['ts']
-
-            if diff_ts == 0:
-                message = "diff_query = " + str(diff_query) + " diff_ts = " + str(diff_ts)
-                return check_levels(0, warning, critical, message)
-
-            query_per_sec = float(diff_query) / float(diff_ts)
-
-            # update the count now
-            if mongo_version == 2:
-                db.nagios_check.update({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-            else:
-                db.nagios_check.update_one({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-
-            message = "Queries / Sec: %f" % query_per_sec
-            message += performance_data(perf_data, [(query_per_sec, "%s_per_sec" % query_type, warning, critical, message)])
-        except KeyError:
+        # grab all the counts, a reset counter is taken as the delta by calc_delta()
+        counts = [int(data['opcounters'][q]) for q in query_types]
+        err, delta = maintain_delta(counts, host, port, "query_counts")
+        if err == 1:
             #
-            # since it is the first run insert it
-            query_per_sec = 0
+            # since it is the first run there's nothing to compare with
             message = "First run of check.. no data"
-            if mongo_version == 2:
-                db.nagios_check.update({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
-            else:
-                db.nagios_check.update_one({u'_id': last_count['_id']}, {'$set': {"data.%s" % query_type: {'count': num, 'ts': int(time.time())}}})
+            return check_levels(0, warning, critical, message)
+        elif err != 0:
+            return exit_with_general_warning("problem reading data from state store")
 
-        except TypeError:
-            #
-            # since it is the first run insert it
-            query_per_sec = 0
-            message = "First run of check.. no data"
-            if mongo_version == 2:
-                db.nagios_check.insert({'check': 'query_counts', 'data': {query_type: {'count': num, 'ts': int(time.time())}}})
-            else:
-                db.nagios_check.insert_one({'check': 'query_counts', 'data': {query_type: {'count': num, 'ts': int(time.time())}}})
+        diff_ts = delta[0]
+        if diff_ts == 0:
+            message = "diff_query = " + str(delta[query_types.index(query_type) + 1]) + " diff_ts = " + str(diff_ts)
+            return check_levels(0, warning, critical, message)
+
+        rates = dict(zip(query_types, [float(d) / float(diff_ts) for d in delta[1:]]))
+        query_per_sec = rates[query_type]
 
+        message = "Queries / Sec: %f" % query_per_sec
+        message += performance_data(perf_data, [(query_per_sec, "%s_per_sec" % query_type, warning, critical)] +
+                    [(rates[q], "%s_per_sec" % q) for q in query_types if q != query_type])
         return check_levels(query_per_sec, warning, critical, message)
 
     except Exception, e:
         return exit_with_general_critical(e)
 
 
-def check_oplog(con, warning, critical, perf_data):
+def check_oplog(con, host, port, warning, critical, perf_data):
     """ Checking the oplog time - the time of the log currntly saved in the oplog collection
     defaults:
         critical 4 hours
@@ -1134,17 +1463,10 @@ def check_oplog(con, warning, critical, perf_data):
     warning = warning or 24
     critical = critical or 4
     try:
-        db = con.local
-        ol = db.system.namespaces.find_one({"name": "local.oplog.rs"})
-        if (db.system.namespaces.find_one({"name": "local.oplog.rs"}) != None):
-            oplog = "oplog.rs"
-        else:
-            ol = db.system.namespaces.find_one({"name": "local.oplog.$main"})
-            if (db.system.namespaces.find_one({"name": "local.oplog.$main"}) != None):
-                oplog = "oplog.$main"
-            else:
-                message = "neither master/slave nor replica set replication detected"
-                return check_levels(None, warning, critical, message)
+        oplog = get_oplog_collection(con, host, port)
+        if oplog is None:
+            message = "neither master/slave nor replica set replication detected"
+            return check_levels(None, warning, critical, message)
 
         try:
                 set_read_preference(con.admin)
@@ -1155,9 +1477,9 @@ def check_oplog(con, warning, critical, perf_data):
         ol_size = data['size']
         ol_storage_size = data['storageSize']
         ol_used_storage = int(float(ol_size) / ol_storage_size * 100 + 1)
-        ol = con.local[oplog]
-        firstc = ol.find().sort("$natural", pymongo.ASCENDING).limit(1)[0]['ts']
-        lastc = ol.find().sort("$natural", pymongo.DESCENDING).limit(1)[0]['ts']
+        firstc, lastc = get_oplog_first_last(con, oplog)
+        # keep the window for replication_lag_percent
+        store_state(host, port, "oplog_window", str(lastc.time - firstc.time))
         time_in_oplog = (lastc.as_datetime() - firstc.as_datetime())
         message = "Oplog saves " + str(time_in_oplog) + " %d%% used" % ol_used_storage
         try:  # work starting from python2.7
@@ -1257,7 +1579,7 @@ def check_opcounters(con, host, port, warning, critical, perf_data):
                     (per_minute_delta[5], "getmore"), (per_minute_delta[6], "command")]))
         return check_levels(per_minute_delta[0], warning, critical, message)
     else:
-        return exit_with_general_critical("problem reading data from temp file")
+        return exit_with_general_critical("problem reading data from state store")
 
 
 def check_current_lock(con, host, port, warning, critical, perf_data):
@@ -1276,7 +1598,7 @@ def check_current_lock(con, host, port, warning, critical, perf_data):
         message += performance_data(perf_data, [("%.2f" % lock_percentage, "current_lock_percentage", warning, critical)])
         return check_levels(lock_percentage, warning, critical, message)
     else:
-        return exit_with_general_warning("problem reading data from temp file")
+        return exit_with_general_warning("problem reading data from state store")
 
 
 def check_page_faults(con, host, port, warning, critical, perf_data):
@@ -1298,7 +1620,7 @@ def check_page_faults(con, host, port, warning, critical, perf_data):
         message += performance_data(perf_data, [("%.2f" % page_faults_ps, "page_faults_ps", warning, critical)])
         return check_levels(page_faults_ps, warning, critical, message)
     else:
-        return exit_with_general_warning("problem reading data from temp file")
+        return exit_with_general_warning("problem reading data from state store")
 
 
 def check_asserts(con, host, port, warning, critical, perf_data):
@@ -1337,7 +1659,7 @@ def check_asserts(con, host, port, warning, critical, perf_data):
                     (warning_ps, "warning"), (msg_ps, "msg"), (user_ps, "user")])
         return check_levels(total_ps, warning, critical, message)
     else:
-        return exit_with_general_warning("problem reading data from temp file")
+        return exit_with_general_warning("problem reading data from state store")
 
 
 def get_stored_primary_server_name(db):
@@ -1412,48 +1734,70 @@ def check_page_faults(con, sample_time, warning, critical, perf_data):
         exit_with_general_critical(e)
 
 
-def chunks_balance(con, database, collection, warning, critical):
+def aggregate(col, pipeline):
+    result = col.aggregate(pipeline)
+    # pymongo < 3 returns the raw command result
+    if isinstance(result, dict):
+        return result['result']
+    return list(result)
+
+
+def chunks_balance(con, database, collection, warning, critical, perf_data, all_namespaces=False):
     warning = warning or 10
     critical = critical or 20
-    nsfilter = database + "." + collection
     try:
         try:
             set_read_preference(con.admin)
-            col = con.config.chunks
-            nscount = col.find({"ns": nsfilter}).count()
-            shards = col.distinct("shard")
+            config = con.config
+            if all_namespaces:
+                namespaces = sorted([c['_id'] for c in config.collections.find({"dropped": {"$ne": True}})])
+                match = {"ns": {"$in": namespaces}}
+            else:
+                namespaces = [database + "." + collection]
+                match = {"ns": namespaces[0]}
+            shards = sorted([s['_id'] for s in config.shards.find()])
+
+            chunks = {}
+            for row in aggregate(config.chunks, [{"$match": match}, {"$group": {"_id": {"ns": "$ns", "shard": "$shard"}, "count": {"$sum": 1}}}]):
+                chunks.setdefault(row['_id']['ns'], {})[row['_id']['shard']] = row['count']
 
         except:
             print "WARNING - Can't get chunks infos from MongoDB"
             sys.exit(1)
 
-        if nscount == 0:
-            print "WARNING - Namespace %s is not sharded" % (nsfilter)
+        if not chunks or not shards:
+            print "WARNING - Namespace %s is not sharded" % (", ".join(namespaces))
             sys.exit(1)
 
-        avgchunksnb = nscount / len(shards)
-        warningnb = avgchunksnb * warning / 100
-        criticalnb = avgchunksnb * critical / 100
-
-        for shard in shards:
-            delta = abs(avgchunksnb - col.find({"ns": nsfilter, "shard": shard}).count())
-            message = "Namespace: %s, Shard name: %s, Chunk delta: %i" % (nsfilter, shard, delta)
-
-            if delta >= criticalnb and delta > 0:
-                print "CRITICAL - Chunks not well balanced " + message
-                sys.exit(2)
-            elif delta >= warningnb  and delta > 0:
-                print "WARNING - Chunks not well balanced  " + message
-                sys.exit(1)
-
-        print "OK - Chunks well balanced across shards"
-        sys.exit(0)
+        worst = None
+        perf_data_param = [()]
+        for nsfilter in namespaces:
+            if nsfilter not in chunks:
+                continue
+            avgchunksnb = float(sum(chunks[nsfilter].values())) / len(shards)
+            for shard in shards:
+                nscount = chunks[nsfilter].get(shard, 0)
+                delta = abs(avgchunksnb - nscount)
+                # chunks can't be split any further than one
+                if delta < 1:
+                    imbalance = 0.0
+                else:
+                    imbalance = delta / avgchunksnb * 100
+                if worst is None or imbalance > worst[0]:
+                    worst = (imbalance, nsfilter, shard, delta)
+                perf_data_param.append((nscount, "%s_%s_chunks" % (nsfilter, shard)))
+
+        imbalance, nsfilter, shard, delta = worst
+        perf_data_param[0] = ("%.2f" % imbalance, "imbalance_percent", warning, critical)
+        perf_data_param.insert(1, ("%i" % delta, "worst_chunk_delta"))
+        message = "Chunks imbalance: %.2f%%, Namespace: %s, Shard name: %s, Chunk delta: %i" % (imbalance, nsfilter, shard, delta)
+        if all_namespaces:
+            message += ", %i namespaces checked" % len(chunks)
+        message += performance_data(perf_data, perf_data_param)
+        return check_levels(imbalance, warning, critical, message)
 
     except Exception, e:
-        exit_with_general_critical(e)
-
-    print "OK - Chunks well balanced across shards"
-    sys.exit(0)
+        return exit_with_general_critical(e)
 
 
 def check_connect_primary(con, warning, critical, perf_data):
@@ -1512,14 +1856,20 @@ def check_row_count(con, database, collection, warning, critical, perf_data):
         return exit_with_general_critical(e)
 
 
-def build_file_name(host, port, action):
-    #done this way so it will work when run independently and from shell
-    module_name = re.match('(.*//*)*(.*)\..*', __file__).group(2)
+# rows of the delta state store not updated for this long are evicted
+STATE_MAX_AGE = 7 * 24 * 3600
+# upper bound on the number of (host, port, action) keys kept in the store
+STATE_MAX_KEYS = 10000
+# seconds the oplog window used by the replication lag percent actions is cached
+OPLOG_WINDOW_TTL = 300
+# seconds the name of the oplog collection of a host is cached
+OPLOG_COLLECTION_TTL = 24 * 3600
 
-    if (port == 27017):
-        return "/tmp/" + module_name + "_data/" + host + "-" + action + ".data"
-    else:
-        return "/tmp/" + module_name + "_data/" + host + "-" + str(port) + "-" + action + ".data"
+
+def build_state_file_name():
+    #done this way so it will work when run independently and from shell
+    module_name = os.path.splitext(os.path.basename(__file__))[0]
+    return "/tmp/" + module_name + "_data/state.db"
 
 
 def ensure_dir(f):
@@ -1528,35 +1878,95 @@ def ensure_dir(f):
         os.makedirs(d)
 
 
-def write_values(file_name, string):
-    f = None
+def create_state_store(file_name):
+    """ Build the store under a private name and link it into place, so no check ever opens it half created """
+    import sqlite3
+    import tempfile
+
+    fd, temp_name = tempfile.mkstemp(prefix=os.path.basename(file_name) + ".", dir=os.path.dirname(file_name))
+    os.close(fd)
+    try:
+        db = sqlite3.connect(temp_name, isolation_level=None)
+        try:
+            # page_size and journal_mode=WAL are kept in the file. Small pages and a table
+            # clustered on its key make a check's update write a single 512 byte page.
+            db.execute("PRAGMA page_size=512")
+            db.execute("PRAGMA journal_mode=WAL")
+            table = "CREATE TABLE deltas (host TEXT, port INTEGER, action TEXT, vals TEXT, updated INTEGER, PRIMARY KEY (host, port, action))"
+            if sqlite3.sqlite_version_info >= (3, 8, 2):
+                table += " WITHOUT ROWID"
+            db.execute(table)
+        finally:
+            db.close()
+        try:
+            os.link(temp_name, file_name)
+        except OSError:
+            # another check created it first
+            if not os.path.exists(file_name):
+                raise
+    finally:
+        os.unlink(temp_name)
+
+
+def open_state_store():
+    """ The connection to the delta state store of this process, created on first use """
+    global state_store
+    import sqlite3
+
+    key = (os.getpid(), build_state_file_name())
+    if state_store is not None and state_store[0] == key:
+        return state_store[1]
+
+    file_name = key[1]
+    if not os.path.exists(file_name):
+        ensure_dir(file_name)
+        create_state_store(file_name)
+    db = sqlite3.connect(file_name, timeout=10, isolation_level=None)
+    # losing the last delta on a power cut is fine, an fsync on every check is not
+    db.execute("PRAGMA synchronous=NORMAL")
+    state_store = (key, db)
+    return db
+
+
+def exchange_values(host, port, action, vals):
+    """ Atomically store vals for (host, port, action) and return the previously stored ones, or None """
+    now = int(time.time())
+    db = open_state_store()
+    # take the write lock before reading so concurrent checks can't interleave
+    db.execute("BEGIN IMMEDIATE")
     try:
-        f = open(file_name, 'w')
-    except IOError, e:
-        #try creating
-        if (e.errno == 2):
-            ensure_dir(file_name)
-            f = open(file_name, 'w')
+        row = db.execute("SELECT vals FROM deltas WHERE host = ? AND port = ? AND action = ?", (host, port, action)).fetchone()
+        if row is not None:
+            db.execute("UPDATE deltas SET vals = ?, updated = ? WHERE host = ? AND port = ? AND action = ?", (vals, now, host, port, action))
         else:
-            raise IOError(e)
-    f.write(string)
-    f.close()
-    return 0
+            db.execute("INSERT INTO deltas (host, port, action, vals, updated) VALUES (?, ?, ?, ?, ?)", (host, port, action, vals, now))
+            # a new key, evict stale ones and keep the store bounded (scans the table, but
+            # an index on updated would cost every other check a second page write)
+            db.execute("DELETE FROM deltas WHERE updated < ?", (now - STATE_MAX_AGE,))
+            db.execute("DELETE FROM deltas WHERE updated <= (SELECT updated FROM deltas ORDER BY updated DESC LIMIT 1 OFFSET ?)", (STATE_MAX_KEYS,))
+        db.execute("COMMIT")
+    except:
+        db.execute("ROLLBACK")
+        raise
 
+    if row is None:
+        return None
+    return row[0]
 
-def read_values(file_name):
-    data = None
-    try:
-        f = open(file_name, 'r')
-        data = f.read()
-        f.close()
-        return 0, data
-    except IOError, e:
-        if (e.errno == 2):
-            #no previous data
-            return 1, ''
-    except Exception, e:
-        return 2, None
+
+def load_state(host, port, action, max_age):
+    """ Return the values stored for (host, port, action) if updated in the last max_age seconds, or None """
+    db = open_state_store()
+    row = db.execute("SELECT vals FROM deltas WHERE host = ? AND port = ? AND action = ? AND updated >= ?", (host, port, action, int(time.time()) - max_age)).fetchone()
+
+    if row is None:
+        return None
+    return row[0]
+
+
+def store_state(host, port, action, vals):
+    db = open_state_store()
+    db.execute("INSERT OR REPLACE INTO deltas (host, port, action, vals, updated) VALUES (?, ?, ?, ?, ?)", (host, port, action, vals, int(time.time())))
 
 
 def calc_delta(old, new):
@@ -1572,34 +1982,283 @@ def calc_delta(old, new):
 
 
 def maintain_delta(new_vals, host, port, action):
-    file_name = build_file_name(host, port, action)
-    err, data = read_values(file_name)
-    old_vals = data.split(';')
     new_vals = [str(int(time.time()))] + new_vals
-    delta = None
     try:
-        err, delta = calc_delta(old_vals, new_vals)
+        old_vals = exchange_values(host, port, action, ";" . join(str(x) for x in new_vals))
+    except Exception:
+        return 2, None
+    if old_vals is None:
+        #no previous data
+        return 1, None
+    try:
+        err, delta = calc_delta(old_vals.split(';'), new_vals)
     except:
-        err = 2
-    write_res = write_values(file_name, ";" . join(str(x) for x in new_vals))
-    return err + write_res, delta
-
-
-def replication_get_time_diff(con):
-    col = 'oplog.rs'
-    local = con.local
-    ol = local.system.namespaces.find_one({"name": "local.oplog.$main"})
-    if ol:
-        col = 'oplog.$main'
-    firstc = local[col].find().sort("$natural", 1).limit(1)
-    lastc = local[col].find().sort("$natural", -1).limit(1)
-    first = firstc.next()
-    last = lastc.next()
-    tfirst = first["ts"]
-    tlast = last["ts"]
+        return 2, None
+    return err, delta
+
+
+def get_oplog_collection(con, host, port):
+    """ Name of the oplog collection in the local database or None without replication, cached per host """
+    cached = load_state(host, port, "oplog_collection", OPLOG_COLLECTION_TTL)
+    if cached is not None:
+        return cached or None
+
+    names = con.local.collection_names()
+    oplog = ""
+    for name in ("oplog.rs", "oplog.$main"):
+        if name in names:
+            oplog = name
+            break
+    store_state(host, port, "oplog_collection", oplog)
+    return oplog or None
+
+
+def get_oplog_first_last(con, oplog):
+    """ ts of the first and the last oplog entry, reading a single projected document from each end """
+    ol = con.local[oplog]
+    first = ol.find({}, {'ts': 1, '_id': 0}).sort("$natural", pymongo.ASCENDING).limit(1).next()
+    last = ol.find({}, {'ts': 1, '_id': 0}).sort("$natural", pymongo.DESCENDING).limit(1).next()
+    return first['ts'], last['ts']
+
+
+def replication_get_time_diff(con, host, port):
+    oplog = get_oplog_collection(con, host, port)
+    if oplog is None:
+        raise Exception("neither master/slave nor replica set replication detected")
+    tfirst, tlast = get_oplog_first_last(con, oplog)
     delta = tlast.time - tfirst.time
     return delta
 
+
+def get_oplog_window(con, host, port):
+    """ Seconds between the first and the last entry of the oplog, cached in the state store for OPLOG_WINDOW_TTL seconds """
+    cached = load_state(host, port, "oplog_window", OPLOG_WINDOW_TTL)
+    if cached is not None:
+        return float(cached)
+    window = replication_get_time_diff(con, host, port)
+    store_state(host, port, "oplog_window", str(window))
+    return window
+
+
+def get_primary_oplog_window(primary, *connect_args):
+    """ Oplog window of the primary given as host:port, only connecting to it when the cached window expired.
+    Returns (err, window) like mongo_connect()"""
+    phost = primary.split(':')[0]
+    pport = int(primary.split(':')[1])
+    cached = load_state(phost, pport, "oplog_window", OPLOG_WINDOW_TTL)
+    if cached is not None:
+        return 0, float(cached)
+
+    err, con = mongo_connect(phost, pport, *connect_args)
+    if err != 0:
+        return err, None
+    return 0, get_oplog_window(con, phost, pport)
+
+
+#
+# Collector mode: a long running process keeping one pooled connection per host
+# and serving cached snapshots over a unix socket to check_mongodb.py --via-collector
+#
+def collector_key(host, port):
+    return "%s:%s" % (host, port)
+
+
+def parse_collector_hosts(hosts, default_port):
+    result = []
+    for host in hosts.split(','):
+        host = host.strip()
+        if not host:
+            continue
+        if ':' in host:
+            name, port = host.rsplit(':', 1)
+            result.append((name, int(port)))
+        else:
+            result.append((host, default_port))
+    return result
+
+
+def collect_snapshot(con):
+    snapshot = {}
+    snapshot['serverStatus'] = con.admin.command(son.SON([('serverStatus', 1)]))
+    snapshot['isMaster'] = con.admin.command(son.SON([('isMaster', 1)]))
+    try:
+        snapshot['replSetGetStatus'] = con.admin.command(son.SON([('replSetGetStatus', 1)]))
+        # read the same way the replication lag checks do, for the slaveDelay of the members
+        snapshot['replSetConfig'] = con.local.system.replset.find_one()
+    except pymongo.errors.OperationFailure:
+        # not running with --replSet
+        pass
+    snapshot['listDatabases'] = con.admin.command(son.SON([('listDatabases', 1)]))
+    snapshot['dbstats'] = {}
+    for db in snapshot['listDatabases']['databases']:
+        snapshot['dbstats'][db['name']] = con[db['name']].command('dbstats')
+    snapshot['fetched'] = time.time()
+    return snapshot
+
+
+def run_collector(options):
+    import threading
+    import signal
+    import SocketServer
+    import bson
+
+    hosts = parse_collector_hosts(options.collector_hosts or options.host, options.port)
+    connections = {}
+    snapshots = {}
+    lock = threading.Lock()
+
+    def refresh():
+        while True:
+            for host, port in hosts:
+                key = collector_key(host, port)
+                try:
+                    if key not in connections:
+                        err, con = mongo_connect(host, port, options.ssl, options.user, options.passwd, None, options.authdb, options.insecure, options.cert_file)
+                        if err != 0:
+                            raise Exception("Connection to Mongo server on %s has failed" % key)
+                        connections[key] = con
+                    snapshot = collect_snapshot(connections[key])
+                except (Exception, SystemExit), e:
+                    snapshot = {'fetched': time.time(), 'error': str(e)}
+                lock.acquire()
+                try:
+                    snapshots[key] = snapshot
+                finally:
+                    lock.release()
+            time.sleep(options.collector_interval)
+
+    class SnapshotHandler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            key = self.rfile.readline().strip()
+            lock.acquire()
+            try:
+                snapshot = snapshots.get(key)
+            finally:
+                lock.release()
+            if snapshot is None:
+                snapshot = {'fetched': time.time(), 'error': "%s is not collected (yet)" % key}
+            self.wfile.write(bson.BSON.encode(snapshot))
+
+    directory = os.path.dirname(options.collector_socket)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    if os.path.exists(options.collector_socket):
+        os.unlink(options.collector_socket)
+    # created with its final permissions, there is no window in which others can connect
+    umask = os.umask(077)
+    try:
+        server = SocketServer.ThreadingUnixStreamServer(options.collector_socket, SnapshotHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+
+    refresher = threading.Thread(target=refresh)
+    refresher.daemon = True
+    refresher.start()
+    # make sure the socket is removed when stopped by an init script
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(options.collector_socket)
+    return 0
+
+
+def collector_connect(options):
+    import socket
+    import bson
+
+    key = collector_key(options.host, options.port)
+    try:
+        # anyone could have bound a socket at that path while the collector was down
+        if os.stat(options.collector_socket).st_uid != os.getuid():
+            raise Exception("the socket is owned by another user")
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(10)
+        s.connect(options.collector_socket)
+        s.sendall(key + "\n")
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        s.close()
+        snapshot = bson.BSON("".join(chunks)).decode()
+    except Exception, e:
+        print "UNKNOWN - Can't read snapshot from collector on %s: %s" % (options.collector_socket, e)
+        return 3, None
+
+    if 'error' in snapshot:
+        return exit_with_general_critical(snapshot['error']), None
+
+    age = time.time() - snapshot['fetched']
+    if age > options.collector_max_age:
+        print "UNKNOWN - Collector snapshot for %s is %i seconds old" % (key, age)
+        return 3, None
+
+    return 0, CollectorSnapshot(snapshot)
+
+
+class CollectorSnapshot(object):
+    """ Stands in for a MongoClient, answering commands from a collector snapshot """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, name):
+        return CollectorDatabase(self.snapshot, name)
+
+    def __getattr__(self, name):
+        return CollectorDatabase(self.snapshot, name)
+
+    def server_info(self):
+        return {'version': self.snapshot['serverStatus']['version']}
+
+
+class CollectorDatabase(object):
+    def __init__(self, snapshot, name):
+        self.snapshot = snapshot
+        self.name = name
+
+    def command(self, command, *args, **kwargs):
+        # options such as maxTimeMS don't apply to a snapshot
+        if not isinstance(command, basestring):
+            command = command.keys()[0]
+
+        if command.lower() == 'ismaster':
+            return self.snapshot['isMaster']
+        elif command == 'dbstats' and self.name in self.snapshot['dbstats']:
+            return self.snapshot['dbstats'][self.name]
+        elif command == 'replSetGetStatus' and command not in self.snapshot:
+            raise pymongo.errors.OperationFailure('not running with --replSet"', 76)
+        elif command in ('serverStatus', 'replSetGetStatus', 'listDatabases'):
+            return self.snapshot[command]
+        raise pymongo.errors.OperationFailure("%s on %s is not available from the collector" % (command, self.name))
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return CollectorCollection(self.snapshot, self.name, name)
+
+
+class CollectorCollection(object):
+    """ Only local.system.replset can be read, from the replica set config in the snapshot """
+    def __init__(self, snapshot, database, name):
+        self.snapshot = snapshot
+        self.database = database
+        self.name = name
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return CollectorCollection(self.snapshot, self.database, self.name + '.' + name)
+
+    def find_one(self, *args, **kwargs):
+        if self.database == 'local' and self.name == 'system.replset' and 'replSetConfig' in self.snapshot:
+            return self.snapshot['replSetConfig']
+        raise pymongo.errors.OperationFailure("%s.%s is not available from the collector" % (self.database, self.name))
+
+
 #
 # main app
 #
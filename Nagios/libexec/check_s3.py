@@ -10,6 +10,13 @@ import collections
 import signal
 import time
 import botocore
+import threading
+import Queue
+import struct
+import hashlib
+import calendar
+import tempfile
+import contextlib
 from pprint import pprint
 from datetime import datetime
 from datetime import timedelta
@@ -39,9 +46,13 @@ alerts = []
 
 # Dictionaries
 aws_response = {}
+aws_clients = {}
 bucket_list = {}
 metric_list = {}
 
+# Objects
+aws_session = None
+
 # Numbers
 low = 0
 high = float('inf')
@@ -71,7 +82,7 @@ def parse_args():
     parser.add_option("-v", "--verbose", action='store_true', help="Display more information for troubleshooting.")
     parser.add_option("-S", "--statistics", default="Average,Minimum,Maximum,Sum", help="The metric statistics. For multiple statistics, Enter a comma delimited list. (Average | Sum | Minimum | Maximum)")
     parser.add_option("-P", "--period", default="5", help="The period of time you would like to check against in minutes. (Default: 5 minutes)")
-    parser.add_option("-t", "--timeout", default="3", help="Set the timeout duration in seconds. Defaults to three second timeout.")
+    parser.add_option("-t", "--timeout", help="Set the timeout duration in seconds, 0 for none. Defaults to three second timeout, and to none in inventory mode.")
     parser.add_option("-n", "--metricname", help="The name of the metric you want to check")
     parser.add_option("-m", "--minimum", default='', help="The minimum value used for performance data graphing.")
     parser.add_option("-M", "--maximum", default='', help="The maximum value used for performance data graphing.")
@@ -86,11 +97,32 @@ def parse_args():
     parser.add_option("-p", "--ping", help="Check for existence of specified bucket.")
     parser.add_option("-i", "--filterid", default='', help="Filters metrics configurations that you specify for request metrics on a bucket. You specify a filter id when you create a metrics configuraion.")
 
+    parser.add_option("--batchfile", help="Batch mode (--changemode batch): the buckets and metrics to check. Either the JSON output of getbuckets, checked for every --metricname, or one 'bucket metric [storagetype [filterid]]' per line.")
+    parser.add_option("--passivehost", default='', help="Batch mode: the Nagios host the passive results are submitted for.")
+    parser.add_option("--serviceprefix", default='S3 ', help="Batch mode: prefix of the service descriptions, followed by '<bucket> <metric>'. (Default: 'S3 ')")
+    parser.add_option("--commandfile", default='', help="Batch mode: write PROCESS_SERVICE_CHECK_RESULT commands to this Nagios command file (or spool file) instead of printing send_nsca input.")
+
+    parser.add_option("--regioncache", default='~/.check_s3_regions.json', help="File remembering the region of every bucket looked up, so getbuckets/getregion only ask AWS about new buckets. Set to an empty string to always ask. (Default: ~/.check_s3_regions.json)")
+    parser.add_option("--regioncachettl", default="7", help="How many days a remembered bucket region is used before asking AWS again. (Default: 7 days)")
+    parser.add_option("--threads", default="16", help="How many bucket regions are looked up at the same time. (Default: 16)")
+    parser.add_option("--tscache", default='', help="Directory to keep fetched datapoints in, so each check only asks CloudWatch for the part of the period it hasn't fetched yet. (Off by default)")
+    parser.add_option("--tscachesettle", default="3", help="How many of the last minutes fetched are fetched again by the next check, as CloudWatch keeps aggregating them for a while. (Default: 3 minutes)")
+    parser.add_option("--tscacheretention", default="24", help="How many hours of datapoints are kept in --tscache, at least one period. (Default: 24 hours)")
+    parser.add_option("--inventory", help="Inventory mode (--changemode inventory): an S3 Inventory manifest.json, local or as s3://bucket/key, or a local object listing (inventory style CSV, or 'aws s3 ls --recursive' output, optionally gzipped).")
+    parser.add_option("--inventoryschema", default="Bucket, Key, Size, LastModifiedDate, StorageClass", help="Inventory mode: the columns of a local CSV listing. (Default: 'Bucket, Key, Size, LastModifiedDate, StorageClass')")
+    parser.add_option("--inventorystate", default='', help="Where inventory mode saves the object counts and sizes it added up, and inventorycheck mode reads them from. (Default: ~/.check_s3_inventory_<bucketname>.json)")
+    parser.add_option("--prefixdepth", default="1", help="Inventory mode: how many levels of '/' delimited prefixes objects are added up by. (Default: 1)")
+    parser.add_option("--maxprefixes", default="10000", help="Inventory mode: the most prefixes added up separately, further prefixes are added up as one. (Default: 10000)")
+    parser.add_option("--prefix", default='', help="Inventory modes: only check objects whose key starts with this prefix, which must be no deeper than --prefixdepth.")
+    parser.add_option("--modelcache", default='', help="Directory to keep the AWS service models in once loaded, which makes creating AWS clients faster on later runs. (Off by default)")
+
     parser.add_option("-T", "--debugtimeout", action='store_true', help="Toggle to add wait time to the plugin. Used to test the timeout function.")
 
     options, _ = parser.parse_args()
 
-    # Set timeout value
+    # Set timeout value, reading a whole inventory takes as long as it takes
+    if options.timeout is None:
+        options.timeout = 0 if options.changemode == 'inventory' else 3
     set_timeout(int(options.timeout))
 
     if options.debugtimeout:
@@ -115,9 +147,84 @@ def parse_args():
     # Convert period to an integer for checking purposes (Amazon CloudWatch only accepts seconds as a UOM)
     options.period = (int(options.period) * 60)
 
+    options.regioncache = expanduser(options.regioncache)
+    options.regioncachettl = (float(options.regioncachettl) * 86400)
+    options.tscachesettle = max(0, int(float(options.tscachesettle) * 60))
+    options.tscacheretention = max(float(options.tscacheretention) * 3600, options.period)
+    options.threads = max(1, int(options.threads))
+    options.prefixdepth = max(0, int(options.prefixdepth))
+    options.maxprefixes = max(1, int(options.maxprefixes))
+
     return options
 
 
+#================================
+#
+#        Client Functions
+#
+#================================
+
+# Creating a client loads and parses its service model, so every client is only created once per run
+def get_client(service, region_name=None):
+
+    global aws_session
+
+    if aws_session is None:
+        aws_session = boto3.session.Session(
+            aws_access_key_id=options.accesskeyid,
+            aws_secret_access_key=options.secretaccesskey
+        )
+        if options.modelcache:
+            enable_model_cache(aws_session, options.modelcache)
+
+    key = (service, region_name)
+    if key not in aws_clients:
+        aws_clients[key] = aws_session.client(service, region_name=region_name)
+
+    return aws_clients[key]
+
+# Keeps what botocore's loader parses from its JSON data files (service models, endpoints) in
+# pickles under directory, keyed by botocore version, for the next runs to load instead
+def enable_model_cache(session, directory):
+
+    import cPickle
+
+    try:
+        loader = session._session.get_component('data_loader')
+    except AttributeError:
+        return
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            return
+
+    def cached(load, *names):
+        path = os.path.join(directory, "-".join([botocore.__version__] + [str(name or "latest") for name in names]) + ".pickle")
+        try:
+            with open(path, 'rb') as f:
+                # Unpickling runs code, so only pickles this user wrote are loaded
+                if os.fstat(f.fileno()).st_uid == os.getuid():
+                    return cPickle.load(f)
+        except Exception:
+            pass
+        data = load()
+        try:
+            with replacing_file(path, 'wb') as f:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError, cPickle.PicklingError):
+            pass
+        return data
+
+    load_service_model = loader.load_service_model
+    load_data = loader.load_data
+
+    loader.load_service_model = lambda service_name, type_name, api_version=None: cached(
+        lambda: load_service_model(service_name, type_name, api_version), service_name, type_name, api_version)
+    loader.load_data = lambda name: cached(lambda: load_data(name), name.replace("/", "_"))
+
+
 #================================
 #
 #        Check Function
@@ -127,91 +234,18 @@ def parse_args():
 def check_s3(metric_name, bucket_name, storage_type, period, statistics, access_key_id, secret_access_key, region_name, filterid):
 
     # Build our request
-    aws = boto3.client(
-        'cloudwatch',
-        aws_access_key_id=access_key_id,
-        aws_secret_access_key=secret_access_key,
-        region_name=region_name
-    )
-
-    if (options.filterid and not options.storagetype):
-        # Make the request
-        response = aws.get_metric_statistics(
-            Namespace='AWS/S3',
-            MetricName=metric_name,
-            Dimensions=[
-                {
-                    'Name': 'BucketName',
-                    'Value': bucket_name 
-                },
-                {
-                    'Name': 'FilterId',
-                    'Value': filterid
-                }
-            ],
-            StartTime=(datetime.now() - timedelta(seconds=period)),
-            EndTime=datetime.now(),
-            Period=(period),
-            Statistics=statistics
-        )   
+    aws = get_client('cloudwatch', region_name)
 
-    elif (options.filterid and options.storagetype):
-        # Make the request
-        response = aws.get_metric_statistics(
-            Namespace='AWS/S3',
-            MetricName=metric_name,
-            Dimensions=[
-                {
-                    'Name': 'BucketName',
-                    'Value': bucket_name 
-                },
-                {
-                    'Name': 'StorageType',
-                    'Value': storage_type
-                },
-                {
-                    'Name': 'FilterId',
-                    'Value': filterid
-                }
-            ],
-            StartTime=(datetime.now() - timedelta(seconds=period)),
-            EndTime=datetime.now(),
-            Period=(period),
-            Statistics=statistics
-        )
-
-    elif (options.storagetype and not options.filterid):
-        # Make the request
-        response = aws.get_metric_statistics(
-            Namespace='AWS/S3',
-            MetricName=metric_name,
-            Dimensions=[
-                {
-                    'Name': 'BucketName',
-                    'Value': bucket_name 
-                }, 
-                {
-                    'Name': 'StorageType',
-                    'Value': storage_type
-                }
-            ],
-            StartTime=(datetime.now() - timedelta(seconds=period)),
-            EndTime=datetime.now(),
-            Period=(period),
-            Statistics=statistics
-        )
+    dimensions = get_dimensions(bucket_name, storage_type, filterid)
 
+    if options.tscache:
+        response = get_cached_statistics(aws, 'AWS/S3', metric_name, dimensions, period, statistics)
     else:
         # Make the request
         response = aws.get_metric_statistics(
             Namespace='AWS/S3',
             MetricName=metric_name,
-            Dimensions=[
-                {
-                    'Name': 'BucketName',
-                    'Value': bucket_name 
-                }
-            ],
+            Dimensions=dimensions,
             StartTime=(datetime.now() - timedelta(seconds=period)),
             EndTime=datetime.now(),
             Period=(period),
@@ -221,6 +255,634 @@ def check_s3(metric_name, bucket_name, storage_type, period, statistics, access_
     # Update our global response
     aws_response.update(response)
 
+#================================
+#
+#      Datapoint Cache Functions
+#
+#================================
+
+# With --tscache, datapoints are fetched at a one minute resolution and kept in a file per
+# (namespace, metric, dimensions): a header with the unit, then appended fixed size records.
+# A record holds a minute's SampleCount, Sum, Minimum and Maximum, from which every statistic
+# of any period can be computed. A record with a negative SampleCount marks the time range that
+# was fetched, from its Sum to its timestamp. Later records for the same minute replace earlier ones.
+TS_HEADER = struct.Struct('<4sB15s')
+TS_RECORD = struct.Struct('<Idddd')
+TS_MAGIC = 'S3TS'
+TS_RESOLUTION = 60
+
+# GetMetricStatistics returns at most this many datapoints per request
+MAX_DATAPOINTS = 1440
+
+def get_ts_cache_path(namespace, metric_name, dimensions):
+
+    key = json.dumps([namespace, metric_name, sorted([(d['Name'], d['Value']) for d in dimensions])])
+
+    return os.path.join(options.tscache, hashlib.sha1(key).hexdigest() + '.ts')
+
+# Returns the unit, a dictionary of minute to (SampleCount, Sum, Minimum, Maximum), the range of
+# time that was fetched and the number of records in the file
+def read_ts_cache(path):
+
+    points = {}
+    fetched = (0, 0)
+    records = 0
+
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None, points, fetched, records
+
+    if len(data) < TS_HEADER.size:
+        return None, points, fetched, records
+
+    magic, version, unit = TS_HEADER.unpack_from(data)
+    if magic != TS_MAGIC or version != 1:
+        return None, points, fetched, records
+
+    for offset in range(TS_HEADER.size, len(data) - TS_RECORD.size + 1, TS_RECORD.size):
+        record = TS_RECORD.unpack_from(data, offset)
+        records += 1
+        if record[1] < 0:
+            fetched = (int(record[2]), record[0])
+        else:
+            points[record[0]] = record[1:]
+
+    return unit.rstrip('\0'), points, fetched, records
+
+def write_ts_cache(f, unit, points, fetched, header):
+
+    if header:
+        f.write(TS_HEADER.pack(TS_MAGIC, 1, unit))
+    f.write(''.join([TS_RECORD.pack(timestamp, *points[timestamp]) for timestamp in sorted(points)]))
+    f.write(TS_RECORD.pack(fetched[1], -1, fetched[0], 0, 0))
+
+# Stands in for get_metric_statistics(): answers from the datapoint cache after fetching the part
+# of the period that isn't in it, and returns the statistics over the whole period as one datapoint
+def get_cached_statistics(aws, namespace, metric_name, dimensions, period, statistics):
+
+    if not os.path.isdir(options.tscache):
+        os.makedirs(options.tscache)
+
+    path = get_ts_cache_path(namespace, metric_name, dimensions)
+    unit, points, fetched, records = read_ts_cache(path)
+
+    now = int(time.time())
+    start = now - period
+
+    # Only the part of the period outside the settled part of the fetched range is asked for, the
+    # last --tscachesettle minutes fetched are asked for again as they may have changed since
+    settled = (fetched[0], fetched[1] - options.tscachesettle)
+    if settled[1] <= start or settled[0] >= settled[1]:
+        ranges = [(start, now)]
+        fetched_from = start
+    else:
+        ranges = [(settled[1], now)]
+        if start < settled[0]:
+            ranges.append((start, settled[0]))
+        fetched_from = min(start, settled[0])
+
+    new_points = {}
+    for range_start, range_end in ranges:
+        chunk_start = range_start // TS_RESOLUTION * TS_RESOLUTION
+        while chunk_start < range_end:
+            chunk_end = min(range_end, chunk_start + MAX_DATAPOINTS * TS_RESOLUTION)
+            response = aws.get_metric_statistics(
+                Namespace=namespace,
+                MetricName=metric_name,
+                Dimensions=dimensions,
+                StartTime=datetime.utcfromtimestamp(chunk_start),
+                EndTime=datetime.utcfromtimestamp(chunk_end),
+                Period=TS_RESOLUTION,
+                Statistics=['SampleCount', 'Sum', 'Minimum', 'Maximum']
+            )
+            for datapoint in response['Datapoints']:
+                timestamp = calendar.timegm(datapoint['Timestamp'].utctimetuple())
+                new_points[timestamp] = (datapoint['SampleCount'], datapoint['Sum'], datapoint['Minimum'], datapoint['Maximum'])
+                unit = datapoint['Unit']
+            chunk_start = chunk_end
+
+    points.update(new_points)
+
+    # Drop what is past retention by rewriting the file once it is mostly stale
+    oldest = now - options.tscacheretention
+    kept = dict([(timestamp, point) for timestamp, point in points.items() if timestamp >= oldest])
+    try:
+        if records == 0 or 2 * len(kept) < records:
+            with replacing_file(path, 'wb') as f:
+                write_ts_cache(f, str(unit or ''), kept, (max(fetched_from, oldest), now), True)
+        else:
+            with open(path, 'ab') as f:
+                write_ts_cache(f, str(unit or ''), new_points, (fetched_from, now), False)
+    except (IOError, OSError):
+        pass
+
+    window = [points[timestamp] for timestamp in sorted(points) if start <= timestamp <= now]
+    if not window:
+        return {'Datapoints': []}
+
+    datapoint = {
+        'Timestamp': datetime.utcfromtimestamp(max([timestamp for timestamp in points if start <= timestamp <= now])),
+        'Unit': unit,
+        'SampleCount': sum([point[0] for point in window]),
+        'Sum': sum([point[1] for point in window]),
+        'Minimum': min([point[2] for point in window]),
+        'Maximum': max([point[3] for point in window])
+    }
+    datapoint['Average'] = datapoint['Sum'] / datapoint['SampleCount'] if datapoint['SampleCount'] else 0.0
+
+    return {'Datapoints': [dict([(key, datapoint[key]) for key in ['Timestamp', 'Unit'] + statistics])]}
+
+
+#================================
+#
+#        Batch Functions
+#
+#================================
+
+# GetMetricData takes at most this many queries per request
+MAX_METRIC_DATA_QUERIES = 500
+
+# Units of the S3 metrics, which GetMetricData doesn't return
+metric_units = {
+    "BucketSizeBytes" : "Bytes",
+    "NumberOfObjects" : "Count",
+    "BytesDownloaded" : "Bytes",
+    "BytesUploaded" : "Bytes",
+    "FirstByteLatency" : "Milliseconds",
+    "TotalRequestLatency" : "Milliseconds"
+}
+
+# The daily storage metrics are only published with these StorageType dimensions by default
+default_storage_types = {
+    "BucketSizeBytes" : "StandardStorage",
+    "NumberOfObjects" : "AllStorageTypes"
+}
+
+def get_dimensions(bucket_name, storage_type, filterid):
+
+    dimensions = [{'Name': 'BucketName', 'Value': bucket_name}]
+
+    if storage_type:
+        dimensions.append({'Name': 'StorageType', 'Value': storage_type})
+
+    if filterid:
+        dimensions.append({'Name': 'FilterId', 'Value': filterid})
+
+    return dimensions
+
+# Returns a list of (bucket, region, metric, storage type, filter id) to check
+def read_batch_file(path):
+
+    try:
+        with open(path) as f:
+            content = f.read()
+    except IOError as e:
+        print "Could not read the batch file: %s" % (e)
+        exit(3)
+
+    items = []
+
+    try:
+        # getbuckets output, {"bucket": "region"}
+        buckets = json.loads(content)
+    except ValueError:
+        buckets = None
+
+    if isinstance(buckets, dict):
+        if not options.metricname:
+            print "Specify the metrics to check for the buckets of %s with --metricname." % (path)
+            exit(3)
+        for bucket in sorted(buckets):
+            for metric in options.metricname.split(','):
+                items.append((bucket, buckets[bucket], metric, options.storagetype or default_storage_types.get(metric), options.filterid))
+        return items
+
+    for line in content.splitlines():
+        fields = line.split('#')[0].split()
+        if not fields:
+            continue
+        if len(fields) < 2:
+            print "Batch file lines need a bucket and a metric: %s" % (line)
+            exit(3)
+        storage_type = fields[2] if len(fields) > 2 else (options.storagetype or default_storage_types.get(fields[1]))
+        filterid = fields[3] if len(fields) > 3 else options.filterid
+        items.append((fields[0], options.region, fields[1], storage_type, filterid))
+
+    return items
+
+# Fetches every statistic of every item with GetMetricData, up to 500 queries per request.
+# Returns a dictionary of item to {statistic: latest value}, without statistics that have no data.
+def get_batch_values(items, period, statistics):
+
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(seconds=period)
+
+    values = dict((item, {}) for item in items)
+
+    # CloudWatch is regional, so every bucket is asked for in its own region
+    by_region = collections.defaultdict(list)
+    for item in items:
+        by_region[item[1]].append(item)
+
+    for region, region_items in by_region.items():
+        aws = get_client('cloudwatch', region)
+
+        queries = []
+        query_items = {}
+        for item in region_items:
+            bucket_name, _, metric, storage_type, filterid = item
+            for statistic in statistics:
+                query_id = "q%d" % (len(queries))
+                query_items[query_id] = (item, statistic)
+                queries.append({
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/S3',
+                            'MetricName': metric,
+                            'Dimensions': get_dimensions(bucket_name, storage_type, filterid)
+                        },
+                        'Period': period,
+                        'Stat': statistic
+                    },
+                    'ReturnData': True
+                })
+
+        for i in range(0, len(queries), MAX_METRIC_DATA_QUERIES):
+            kwargs = {
+                'MetricDataQueries': queries[i:i + MAX_METRIC_DATA_QUERIES],
+                'StartTime': start_time,
+                'EndTime': end_time,
+                'ScanBy': 'TimestampDescending'
+            }
+            while True:
+                response = aws.get_metric_data(**kwargs)
+                for result in response['MetricDataResults']:
+                    if result['Values']:
+                        item, statistic = query_items[result['Id']]
+                        values[item].setdefault(statistic, result['Values'][0])
+                if not response.get('NextToken'):
+                    break
+                kwargs['NextToken'] = response['NextToken']
+
+    return values
+
+def check_batch():
+
+    global return_units
+
+    if not options.batchfile:
+        print "Batch mode needs a --batchfile."
+        exit(3)
+
+    if not options.passivehost:
+        print "Batch mode needs the --passivehost to submit the results for."
+        exit(3)
+
+    items = read_batch_file(options.batchfile)
+    values = get_batch_values(items, options.period, statistics)
+
+    results = []
+    for item in items:
+        bucket_name, _, metric, storage_type, filterid = item
+        service = "%s%s %s" % (options.serviceprefix, bucket_name, metric)
+
+        if len(values[item]) < len(statistics):
+            results.append((service, 0, "No data in the current check period. Try increasing the check period to see data."))
+            continue
+
+        datapoint_dict = {}
+        for statistic, warning_threshold, critical_threshold in zip(statistics, warning, critical):
+            datapoint_dict[statistic] = {
+                'warning': warning_threshold or '0:',
+                'critical': critical_threshold or '0:',
+                'return_code': 0,
+                'value': values[item][statistic]
+            }
+            threshold_string_to_tuple(datapoint_dict[statistic]['warning'])
+            if check_against_thresholds(datapoint_dict[statistic]['value']):
+                datapoint_dict[statistic]['return_code'] = 1
+            threshold_string_to_tuple(datapoint_dict[statistic]['critical'])
+            if check_against_thresholds(datapoint_dict[statistic]['value']):
+                datapoint_dict[statistic]['return_code'] = 2
+
+        return_units = unit_to_uom(metric_units.get(metric, "Count"))
+        create_return_data(datapoint_dict, metric)
+        results.append((service, highest_return_code, fulldata.strip()))
+
+    worst = max([0] + [result[1] for result in results])
+
+    if options.commandfile:
+        now = int(time.time())
+        try:
+            with open(options.commandfile, 'a') as f:
+                for service, code, output in results:
+                    f.write("[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % (now, options.passivehost, service, code, output))
+        except IOError as e:
+            print "Could not write to the command file %s: %s" % (options.commandfile, e)
+            exit(3)
+        print "%s: Submitted %d passive check results" % (['OK', 'WARNING', 'CRITICAL', 'UNKNOWN'][worst], len(results))
+        exit(worst)
+
+    for service, code, output in results:
+        print "%s\t%s\t%d\t%s" % (options.passivehost, service, code, output)
+    exit(worst)
+
+#================================
+#
+#       Inventory Functions
+#
+#================================
+
+# Inventory files are read this many bytes at a time, whatever their size
+INVENTORY_CHUNK_SIZE = 1024 * 1024
+
+# Objects beyond --maxprefixes distinct prefixes are added up under this prefix
+OTHER_PREFIXES = '(other)'
+
+# Yields the content of a local file or S3 object (s3://bucket/key) in chunks, gunzipped if needed
+def iter_inventory_chunks(location):
+
+    import zlib
+
+    if location.startswith('s3://'):
+        bucket, _, key = location[5:].partition('/')
+        f = get_client('s3').get_object(Bucket=bucket, Key=key)['Body']
+    else:
+        f = open(location, 'rb')
+
+    # Closed when read to the end, and when the reader stops early (the generator is closed)
+    try:
+        decompressor = None
+        first = True
+        while True:
+            chunk = f.read(INVENTORY_CHUNK_SIZE)
+            if not chunk:
+                break
+            if first and chunk[:2] == '\x1f\x8b':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            first = False
+            while decompressor and chunk:
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+                # Concatenated gzip members
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if not decompressor:
+                yield chunk
+
+        if decompressor:
+            data = decompressor.flush()
+            if data:
+                yield data
+    finally:
+        f.close()
+
+def iter_lines(chunks):
+
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+# Yields (key, size, storage class, is latest version) of the rows of a CSV inventory file
+def iter_csv_objects(lines, schema):
+
+    import csv
+    import urllib
+
+    columns = [column.strip() for column in schema.split(',')]
+    key_index = columns.index('Key')
+    size_index = columns.index('Size') if 'Size' in columns else None
+    class_index = columns.index('StorageClass') if 'StorageClass' in columns else None
+    latest_index = columns.index('IsLatest') if 'IsLatest' in columns else None
+    marker_index = columns.index('IsDeleteMarker') if 'IsDeleteMarker' in columns else None
+
+    for row in csv.reader(lines):
+        if len(row) < len(columns):
+            continue
+        if marker_index is not None and row[marker_index] == 'true':
+            continue
+        # Inventory reports URL-encode keys
+        yield (urllib.unquote_plus(row[key_index]),
+               int(row[size_index] or 0) if size_index is not None else 0,
+               row[class_index] if class_index is not None else '',
+               latest_index is None or row[latest_index] != 'false')
+
+# Yields (key, size, storage class, is latest version) from 'aws s3 ls --recursive' output
+def iter_ls_objects(lines):
+
+    for line in lines:
+        fields = line.split(None, 3)
+        if len(fields) == 4 and fields[2].isdigit():
+            yield (fields[3].rstrip('\r'), int(fields[2]), '', True)
+
+# Yields (key, size, storage class, is latest version) of an ORC or Parquet inventory file,
+# one stripe or row group at a time. Needs pyarrow.
+def iter_columnar_objects(location, file_format):
+
+    import tempfile
+
+    try:
+        import pyarrow
+        if file_format == 'ORC':
+            import pyarrow.orc
+        else:
+            import pyarrow.parquet
+    except ImportError:
+        print "Reading %s inventory files needs the pyarrow module." % (file_format)
+        exit(3)
+
+    # Columnar files are read by seeking, so objects are downloaded to a temporary file first
+    temp_file = None
+    if location.startswith('s3://'):
+        temp_file = tempfile.TemporaryFile()
+        for chunk in iter_inventory_chunks(location):
+            temp_file.write(chunk)
+        temp_file.seek(0)
+        source = temp_file
+    else:
+        source = open(location, 'rb')
+
+    try:
+        if file_format == 'ORC':
+            reader = pyarrow.orc.ORCFile(source)
+            parts = [lambda i=i: reader.read_stripe(i) for i in range(reader.nstripes)]
+        else:
+            reader = pyarrow.parquet.ParquetFile(source)
+            parts = [lambda i=i: reader.read_row_group(i) for i in range(reader.num_row_groups)]
+
+        for read_part in parts:
+            columns = read_part().to_pydict()
+            keys = columns.get('key') or columns.get('Key') or []
+            sizes = columns.get('size') or columns.get('Size') or [0] * len(keys)
+            classes = columns.get('storage_class') or columns.get('StorageClass') or [''] * len(keys)
+            latest = columns.get('is_latest') or columns.get('IsLatest') or [True] * len(keys)
+            markers = columns.get('is_delete_marker') or columns.get('IsDeleteMarker') or [False] * len(keys)
+            for i in range(len(keys)):
+                if not markers[i]:
+                    yield keys[i], sizes[i] or 0, classes[i] or '', latest[i] is not False
+    finally:
+        source.close()
+
+# Returns the objects of every data file of a manifest, or of a listing
+def iter_inventory_objects(location):
+
+    if location.endswith('manifest.json'):
+        manifest = json.loads(''.join(iter_inventory_chunks(location)))
+        file_format = manifest.get('fileFormat', 'CSV').upper()
+        destination = manifest.get('destinationBucket', '').split(':')[-1]
+        for data_file in manifest['files']:
+            if location.startswith('s3://'):
+                data_location = 's3://%s/%s' % (destination, data_file['key'])
+            else:
+                # A local copy of the destination: data files next to the manifest, in data/ or in ../data/
+                name = os.path.basename(data_file['key'])
+                manifest_dir = os.path.dirname(os.path.abspath(location))
+                for data_location in [os.path.join(manifest_dir, name), os.path.join(manifest_dir, 'data', name), os.path.join(manifest_dir, '..', 'data', name)]:
+                    if os.path.exists(data_location):
+                        break
+            if file_format == 'CSV':
+                for item in iter_csv_objects(iter_lines(iter_inventory_chunks(data_location)), manifest['fileSchema']):
+                    yield item
+            else:
+                for item in iter_columnar_objects(data_location, file_format):
+                    yield item
+        return
+
+    lines = iter_lines(iter_inventory_chunks(location))
+    for line in lines:
+        if line.strip():
+            break
+    else:
+        return
+
+    def all_lines():
+        yield line
+        for rest in lines:
+            yield rest
+
+    # 'aws s3 ls' lines start with the date and time of the object
+    if len(line.split(None, 3)) == 4 and line[:4].isdigit() and line[4:5] == '-':
+        objects = iter_ls_objects(all_lines())
+    else:
+        objects = iter_csv_objects(all_lines(), options.inventoryschema)
+    for item in objects:
+        yield item
+
+def get_inventory_state_path():
+
+    if options.inventorystate:
+        return expanduser(options.inventorystate)
+
+    if not options.bucketname:
+        print "Specify the --bucketname or the --inventorystate to use."
+        exit(3)
+
+    return expanduser("~/.check_s3_inventory_%s.json" % (options.bucketname))
+
+def add_inventory_object(totals, prefixes, key, size, storage_class, is_latest):
+
+    prefix = ''.join([part + '/' for part in key.split('/')[:-1][:options.prefixdepth]])
+    if prefix not in prefixes:
+        if len(prefixes) < options.maxprefixes:
+            prefixes.add(prefix)
+        else:
+            prefix = OTHER_PREFIXES
+    total = totals.setdefault((prefix, storage_class), [0, 0])
+    # Older versions count towards the size only
+    if is_latest:
+        total[0] += 1
+    total[1] += size
+
+# Adds up objects and bytes per (prefix, storage class) while streaming through the inventory,
+# and saves the result for inventorycheck
+def process_inventory():
+
+    if not options.inventory:
+        print "Inventory mode needs an --inventory manifest or listing."
+        exit(3)
+
+    totals = {}
+    prefixes = set()
+    objects = 0
+
+    try:
+        for key, size, storage_class, is_latest in iter_inventory_objects(options.inventory):
+            add_inventory_object(totals, prefixes, key, size, storage_class, is_latest)
+            objects += 1
+    except (IOError, ValueError, KeyError) as e:
+        print "Could not read the inventory %s: %s" % (options.inventory, e)
+        exit(3)
+
+    state = {
+        'inventory': options.inventory,
+        'created': int(time.time()),
+        'rows': objects,
+        'totals': [[prefix, storage_class, count, size] for (prefix, storage_class), (count, size) in sorted(totals.items())]
+    }
+
+    path = get_inventory_state_path()
+    try:
+        with replacing_file(path) as f:
+            json.dump(state, f)
+    except (IOError, OSError) as e:
+        print "Could not save the inventory totals to %s: %s" % (path, e)
+        exit(3)
+
+    return state
+
+# Checks the saved (or just computed) totals against the first warning and critical threshold
+def check_inventory(state=None):
+
+    if state is None:
+        path = get_inventory_state_path()
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (IOError, ValueError) as e:
+            print "UNKNOWN: Could not read the inventory totals from %s (run inventory mode first): %s" % (path, e)
+            exit(3)
+
+    metric = options.metricname or 'BucketSizeBytes'
+    if metric not in ('BucketSizeBytes', 'NumberOfObjects'):
+        print "Inventory checks support the BucketSizeBytes and NumberOfObjects metrics."
+        exit(3)
+
+    value = 0
+    for prefix, storage_class, count, size in state['totals']:
+        if options.prefix and not prefix.startswith(options.prefix):
+            continue
+        if options.storagetype and storage_class != options.storagetype:
+            continue
+        value += count if metric == 'NumberOfObjects' else size
+
+    uom = 'B' if metric == 'BucketSizeBytes' else ''
+    warning_threshold = warning[0] or '0:'
+    critical_threshold = critical[0] or '0:'
+
+    return_code = 0
+    threshold_string_to_tuple(warning_threshold)
+    if check_against_thresholds(value):
+        return_code = 1
+    threshold_string_to_tuple(critical_threshold)
+    if check_against_thresholds(value):
+        return_code = 2
+
+    age = datetime.fromtimestamp(state['created']).strftime('%Y-%m-%d %H:%M')
+    print "%s: %s - %s%s (inventory of %s) | %s=%s%s;%s;%s;%s;%s; " % (['OK', 'WARNING', 'CRITICAL', 'UNKNOWN'][return_code],
+        {'BucketSizeBytes': 'Bucket Size Bytes', 'NumberOfObjects': 'Number of Objects'}[metric], value, uom, age,
+        metric, value, uom, options.warning, options.critical, options.minimum, options.maximum)
+    exit(return_code)
+
 #================================
 #
 #       Get Buckets Function
@@ -232,25 +894,13 @@ def get_available_buckets():
     bucket_list = {}
 
     # Build our AWS request
-    aws = boto3.client(
-        's3',
-        aws_access_key_id=options.accesskeyid,
-        aws_secret_access_key=options.secretaccesskey
-    )
+    aws = get_client('s3')
 
     # Make the request
     response = aws.list_buckets()
 
-    # Initialize counter to fake a foreach loop w/ indices
-    counter = 0
-
-    for key, value in response['Buckets']:
-        if (value == 'Name'):
-            # bucketName = bucketRegion
-            bucket_list[response['Buckets'][counter]['Name']] = get_bucket_region(response['Buckets'][counter]['Name']);
-            counter += 1
-        else:
-            continue
+    # bucketName = bucketRegion
+    bucket_list = get_bucket_regions([bucket['Name'] for bucket in response['Buckets']])
 
     bucket_list = json.dumps(bucket_list);
 
@@ -265,16 +915,11 @@ def get_available_buckets():
 #================================
 
 def check_alive():
-    s3 = boto3.resource(
-        's3',
-        aws_access_key_id=options.accesskeyid,
-        aws_secret_access_key=options.secretaccesskey
-    );
+    aws = get_client('s3')
 
-    bucket = s3.Bucket('nagiosxi-official')
     exists = True
     try:
-        s3.meta.client.head_bucket(
+        aws.head_bucket(
             Bucket=options.bucketname,
         )
     except botocore.exceptions.ClientError as e:
@@ -302,12 +947,7 @@ def get_available_metrics(bucket):
     metric_list = {}
 
     # Build our request
-    aws = boto3.client(
-        'cloudwatch',
-        aws_access_key_id=options.accesskeyid,
-        aws_secret_access_key=options.secretaccesskey,
-        region_name=options.region
-    )
+    aws = get_client('cloudwatch', options.region)
 
     # Make the request
     response = aws.list_metrics(
@@ -348,11 +988,7 @@ def print_json(data):
 #================================
 
 def get_bucket_region(bucket):
-    aws = boto3.client(
-        's3',
-        aws_access_key_id=options.accesskeyid,
-        aws_secret_access_key=options.secretaccesskey
-    )
+    aws = get_client('s3')
 
     response = aws.get_bucket_location(
         Bucket=bucket
@@ -365,6 +1001,100 @@ def get_bucket_region(bucket):
         return response['LocationConstraint']
 
 
+# Returns a dictionary of bucket name to region. Regions are taken from the region cache if
+# known, the others are looked up on --threads threads and added to the cache.
+def get_bucket_regions(buckets):
+
+    cache = load_region_cache()
+    now = time.time()
+
+    bucket_regions = {}
+    unknown = Queue.Queue()
+    for bucket in buckets:
+        if bucket in cache and now - cache[bucket][1] < options.regioncachettl:
+            bucket_regions[bucket] = cache[bucket][0]
+        else:
+            unknown.put(bucket)
+
+    if unknown.empty():
+        return bucket_regions
+
+    # Clients are thread-safe, but create it before the threads share it
+    get_client('s3')
+
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                bucket = unknown.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                bucket_regions[bucket] = get_bucket_region(bucket)
+            except Exception as e:
+                errors.append(e)
+                return
+
+    workers = []
+    for i in range(min(options.threads, unknown.qsize())):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    # Joining with a timeout keeps the main thread responsive to the timeout alarm
+    for t in workers:
+        while t.isAlive():
+            t.join(0.1)
+
+    if errors:
+        raise errors[0]
+
+    for bucket in buckets:
+        if bucket not in cache or now - cache[bucket][1] >= options.regioncachettl:
+            cache[bucket] = [bucket_regions[bucket], now]
+    save_region_cache(cache)
+
+    return bucket_regions
+
+def load_region_cache():
+
+    if not options.regioncache:
+        return {}
+
+    try:
+        with open(options.regioncache) as f:
+            # A file someone else put there could send checks to the wrong region
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                return {}
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict):
+        return {}
+
+    return cache
+
+def save_region_cache(cache):
+
+    if not options.regioncache:
+        return
+
+    # Forget buckets that weren't looked at for a long time (most likely deleted)
+    now = time.time()
+    for bucket in cache.keys():
+        if now - cache[bucket][1] >= 2 * options.regioncachettl:
+            del cache[bucket]
+
+    try:
+        with replacing_file(options.regioncache) as f:
+            json.dump(cache, f)
+    except (IOError, OSError):
+        pass
+
+
 # For some reason unbeknownst to me, some processing will not work in parse_args(), so it happens here.
 def process_input():
 
@@ -446,6 +1176,24 @@ def set_timeout(seconds):
     signal.signal(signal.SIGALRM, timeout_handler)
     signal.alarm(seconds)
 
+# Opens a new file that replaces path once the with block is done, so concurrent checks never read it
+# half written. mkstemp() creates it exclusively, rather than following a symlink planted under a
+# predictable name, and readable by this user only.
+@contextlib.contextmanager
+def replacing_file(path, mode='w'):
+
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.rename(temp_path, path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
 def threshold_string_to_tuple(threshold_string):
 
     global options
@@ -523,7 +1271,18 @@ def get_perfdata_string(uom, label, value, warning_threshold, critical_threshold
     return ret_string
 
 
-def create_return_data(dictionary):
+def unit_to_uom(unit):
+
+    if unit == "Percent":
+        return "%"
+    elif unit == "Count":
+        return ""
+    elif unit == "Bytes":
+        return "B"
+    return unit
+
+
+def create_return_data(dictionary, metric_name=None):
 
     global options
     global userdata
@@ -534,6 +1293,9 @@ def create_return_data(dictionary):
 
     userdata_list = []
 
+    if metric_name is None:
+        metric_name = options.metricname
+
     return_list = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
 
     metric_dictionary = {
@@ -556,9 +1318,9 @@ def create_return_data(dictionary):
 
     # Get the highest return code of all statistics checked (pass to fulldata string interpolation and get corresponding return_list index)
     # We want the entire check to return the highest code of the individual
-    highest_return_code = max(dictionary.values())['return_code']
+    highest_return_code = max([item['return_code'] for item in dictionary.values()])
 
-    if (options.metricname == 'CPUUtilization'):
+    if (metric_name == 'CPUUtilization'):
 
         for key in dictionary:
             if (key == "Average"):
@@ -567,9 +1329,9 @@ def create_return_data(dictionary):
                 returnstring = return_list[dictionary[key]['return_code']]
                 userdata_list.append("%s: %s%s" % (key, dictionary[key]['value'], return_units))
         
-        perfdata = "%s=%s%s;%s;%s;%s;%s; " % (options.metricname, dictionary['Average']['value'], return_units, options.warning, options.critical, options.minimum, options.maximum)
+        perfdata = "%s=%s%s;%s;%s;%s;%s; " % (metric_name, dictionary['Average']['value'], return_units, options.warning, options.critical, options.minimum, options.maximum)
 
-        fulldata = "%s: %s %s - %s%s (%s) | %s" % (return_list[highest_return_code], metric_dictionary[options.metricname], "Average", dictionary['Average']['value'], return_units , ", ".join(userdata_list), perfdata)
+        fulldata = "%s: %s %s - %s%s (%s) | %s" % (return_list[highest_return_code], metric_dictionary[metric_name], "Average", dictionary['Average']['value'], return_units , ", ".join(userdata_list), perfdata)
 
     else:
         for key in dictionary:
@@ -579,9 +1341,9 @@ def create_return_data(dictionary):
                 returnstring = return_list[dictionary[key]['return_code']]
                 userdata_list.append("%s: %s%s" % (key, dictionary[key]['value'], return_units))
         
-        perfdata = "%s=%s%s;%s;%s;%s;%s; " % (options.metricname, dictionary['Sum']['value'], return_units, options.warning, options.critical, options.minimum, options.maximum)
+        perfdata = "%s=%s%s;%s;%s;%s;%s; " % (metric_name, dictionary['Sum']['value'], return_units, options.warning, options.critical, options.minimum, options.maximum)
 
-        fulldata = "%s: %s %s - %s (%s) | %s" % (return_list[highest_return_code], metric_dictionary[options.metricname], "Sum", dictionary['Sum']['value'],", ".join(userdata_list), perfdata)
+        fulldata = "%s: %s %s - %s (%s) | %s" % (return_list[highest_return_code], metric_dictionary[metric_name], "Sum", dictionary['Sum']['value'],", ".join(userdata_list), perfdata)
 
 
 #================================
@@ -629,10 +1391,16 @@ def main():
             get_available_metrics(options.bucketname)
             exit(0)
         elif options.changemode == 'getregion':
-            get_bucket_region(options.bucketname)
+            print get_bucket_regions([options.bucketname])[options.bucketname]
             exit(0)
         elif options.changemode == 'checkalive':
             check_alive();
+        elif options.changemode == 'batch':
+            check_batch()
+        elif options.changemode == 'inventory':
+            check_inventory(process_inventory())
+        elif options.changemode == 'inventorycheck':
+            check_inventory()
         else:
             check_s3(options.metricname, options.bucketname, options.storagetype, options.period, statistics, options.accesskeyid, options.secretaccesskey, options.region, options.filterid)
     except botocore.exceptions.NoRegionError:
@@ -688,13 +1456,7 @@ def main():
 
     datapoint_dict = dict(temp_dict)
 
-    return_units = datapoints['Unit']
-    if return_units == "Percent":
-        return_units = "%"
-    elif return_units == "Count":
-        return_units = ""
-    elif return_units == "Bytes":
-        return_units = "B"
+    return_units = unit_to_uom(datapoints['Unit'])
 
     # Check the values for each item, and set the corresponding return code
     for key in datapoint_dict:
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Benchmark of the exist, running and healthy checks of check_docker.py over
+# synthetic /containers/json responses of 10, 1k and 10k containers, every
+# container being selected.
+#
+# The Docker API is replaced by the synthetic responses, so only the time the
+# plugin spends matching the selection against them is measured, including
+# building the per-run container index. The run fails (exit 1) when 10k
+# containers take more than --max-growth times as long as 1k, i.e. when a
+# check turns quadratic again.
+#
+# --compare times another copy of the plugin the same way, e.g. one taken from
+# an older commit with "git show <commit>:Nagios/libexec/check_docker.py".
+#
+# Usage: bench_docker_membership.py [--sizes 10,1000,10000] [--max-growth 30] [--compare FILE]
+#
+
+import sys
+import imp
+import os
+import time
+import optparse
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Nagios', 'libexec', 'check_docker.py')
+CHECKS = ['check_containers_exist', 'check_containers_running', 'check_containers_healthy']
+
+
+def make_containers(n):
+    containers = []
+    for i in range(n):
+        containers.append({
+            'Id': "%064x" % (i * 2654435761),
+            'Names': ["/container%d" % i],
+            'State': i % 10 and "running" or "exited",
+            'Status': ("Up 1 hour (healthy)", "Up 1 hour (unhealthy)", "Up 1 hour")[i % 3],
+        })
+    return containers
+
+
+def fake_talk_to_docker(containers):
+    # the health filters, for a --compare copy that still asks the daemon for them
+    by_health = {'healthy': [], 'unhealthy': []}
+    for container in containers:
+        for health in by_health:
+            if "(%s)" % health in container['Status']:
+                by_health[health].append(container)
+
+    def talk_to_docker(endpoints_list, form_values_list, crash_on_fail=True):
+        for value in form_values_list:
+            for health in by_health:
+                if '["%s"]' % health in value:
+                    return by_health[health]
+        return containers
+    return talk_to_docker
+
+
+def load_plugin(path, name):
+    plugin = imp.load_source(name, path)
+    plugin.options = optparse.Values({
+        'debug': False, 'list_bad_containers': True, 'percentage': False,
+        'ignore_no_healthcheck': False, 'count_unhealthy_containers': False,
+        'missing_healthcheck_is_counted': False,
+    })
+    return plugin
+
+
+def time_check(plugin, check, containers):
+    """ Seconds one run of check over every container takes, the best of a few runs """
+    plugin.talk_to_docker = fake_talk_to_docker(containers)
+    IDs = [container['Id'] for container in containers]
+    best = None
+    runs = max(1, min(5, 20000 / len(containers)))
+    for i in range(runs):
+        # the index is built once per plugin run, so it is part of the cost
+        plugin.container_index = None
+        started = time.time()
+        getattr(plugin, check)(IDs)
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    p = optparse.OptionParser(description="Benchmark the exist/running/healthy membership checks of check_docker.py.")
+    p.add_option('--sizes', default='10,1000,10000', help='Container counts to run (default 10,1000,10000)')
+    p.add_option('--max-growth', type='float', default=30, help='Fail when the largest size takes more than this many times as long as the one before it (default 30, linear is 10 from 1k to 10k)')
+    p.add_option('--compare', default=None, help='Another copy of check_docker.py to time next to this one')
+    options, arguments = p.parse_args()
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    plugins = [('current', load_plugin(PLUGIN, 'check_docker'))]
+    if options.compare:
+        plugins.append(('compare', load_plugin(options.compare, 'check_docker_compare')))
+
+    failed = False
+    print "%-26s %-8s" % ("check", "plugin") + "".join(["%14s" % ("%d" % size) for size in sizes])
+    for check in CHECKS:
+        for name, plugin in plugins:
+            times = [time_check(plugin, check, make_containers(size)) for size in sizes]
+            print "%-26s %-8s" % (check, name) + "".join(["%12.2fms" % (t * 1000) for t in times])
+            if name == 'current' and len(sizes) > 1:
+                growth = times[-1] / max(times[-2], 1e-9)
+                if growth > options.max_growth:
+                    print "%-26s %-8s took %.1fx as long for %d as for %d containers" % ("", "", growth, sizes[-1], sizes[-2])
+                    failed = True
+    return failed and 1 or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
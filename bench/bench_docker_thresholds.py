@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Benchmark of the threshold handling of check_docker.py for large selections:
+# -a with --separate-containers over 1k, 10k and 100k containers, i.e. one
+# CheckData per container.
+#
+# Timed separately: building the per-alias checks (get_threshold_maps), splitting
+# them per container (separate_checks), and evaluating every value against the
+# thresholds (check_all_values_against_thresholds). The size of one per-container
+# CheckData (the object and its __dict__, if any) is reported as well.
+#
+# --compare runs another copy of the plugin the same way, e.g. one taken from an
+# older commit with "git show <commit>:Nagios/libexec/check_docker.py".
+#
+# Usage: bench_docker_thresholds.py [--sizes 1000,10000,100000] [-w 50] [-c 75] [--compare FILE]
+#
+
+import sys
+import os
+import imp
+import time
+import optparse
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Nagios', 'libexec', 'check_docker.py')
+
+
+def load_plugin(path, name):
+    plugin = imp.load_source(name, path)
+    plugin.options = optparse.Values({'debug': False})
+    return plugin
+
+
+def object_size(check):
+    size = sys.getsizeof(check)
+    if hasattr(check, '__dict__'):
+        size += sys.getsizeof(check.__dict__)
+    return size
+
+
+def run(plugin, size, warning, critical):
+    """ Returns the seconds of each phase and the size of one per-container check """
+    IDs = ["%064x" % (i * 2654435761) for i in range(size)]
+    if hasattr(plugin, 'parsed_thresholds'):
+        # parsed once per run
+        plugin.parsed_thresholds.clear()
+
+    started = time.time()
+    checks = plugin.get_threshold_maps(warning, critical, {'all': IDs})
+    built = time.time()
+    checks = plugin.separate_checks(checks)
+    separated = time.time()
+    for i, check in enumerate(checks.itervalues()):
+        check.setValue(i % 100)
+    valued = time.time()
+    plugin.check_all_values_against_thresholds(checks)
+    evaluated = time.time()
+    return built - started, separated - built, evaluated - valued, object_size(checks.itervalues().next())
+
+
+def main():
+    p = optparse.OptionParser(description="Benchmark the threshold evaluation of check_docker.py for large selections.")
+    p.add_option('--sizes', default='1000,10000,100000', help='Container counts to run (default 1000,10000,100000)')
+    p.add_option('-w', '--warning', default='50', help='Warning threshold (default 50)')
+    p.add_option('-c', '--critical', default='75', help='Critical threshold (default 75)')
+    p.add_option('--compare', default=None, help='Another copy of check_docker.py to time next to this one')
+    options, arguments = p.parse_args()
+
+    plugins = [('current', load_plugin(PLUGIN, 'check_docker'))]
+    if options.compare:
+        plugins.append(('compare', load_plugin(options.compare, 'check_docker_compare')))
+
+    print "%-8s %8s %12s %12s %12s %14s" % ("plugin", "checks", "build", "separate", "evaluate", "bytes/check")
+    for size in [int(size) for size in options.sizes.split(',')]:
+        for name, plugin in plugins:
+            build, separate, evaluate, check_size = run(plugin, size, options.warning, options.critical)
+            print "%-8s %8d %10.1fms %10.1fms %10.1fms %14d" % (name, size, build * 1000, separate * 1000, evaluate * 1000, check_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# Benchmark of the round trips check_mongodb.py makes to read the oplog window,
+# against an in-process mongod stand-in that counts every request and can add
+# a network latency to each of them.
+#
+# A simulated poll cycle runs the oplog action and the oplog window lookup of
+# replication_lag_percent against the same host, the way two Nagios services
+# would. The code before the shared oplog window helper (two system.namespaces
+# lookups per branch and full-document $natural scans, repeated by
+# replication_get_time_diff()) is kept here for comparison.
+#
+# Usage: bench_mongodb_oplog.py [--cycles 10] [--latency 1] [--dir DIR]
+#
+
+import sys
+import os
+import imp
+import time
+import shutil
+import datetime
+import optparse
+import tempfile
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Nagios', 'libexec', 'check_mongodb.py')
+
+
+#
+# mongod stand-in
+#
+class Timestamp(object):
+    def __init__(self, t):
+        self.time = t
+
+    def as_datetime(self):
+        return datetime.datetime.utcfromtimestamp(self.time)
+
+
+class Server(object):
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = []
+
+    def request(self, what):
+        self.requests.append(what)
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class Cursor(object):
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+        self.direction = 1
+
+    def sort(self, key, direction=1):
+        self.direction = direction
+        return self
+
+    def limit(self, n):
+        return self
+
+    def next(self):
+        self.server.request("find %s" % self.name)
+        return {'ts': Timestamp(self.direction == 1 and 1000000 or 1000000 + 36 * 3600), 'op': 'i', 'o': {'x': 'y' * 512}}
+
+    def __getitem__(self, i):
+        return self.next()
+
+
+class Collection(object):
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Collection(self.server, self.name + '.' + name)
+
+    def find_one(self, spec=None, *args, **kwargs):
+        self.server.request("find_one %s" % self.name)
+        if self.name == 'system.namespaces' and spec and spec.get('name') == 'local.oplog.rs':
+            return {'name': 'local.oplog.rs'}
+        return None
+
+    def find(self, *args, **kwargs):
+        return Cursor(self.server, self.name)
+
+
+class Database(object):
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Collection(self.server, name)
+
+    def __getitem__(self, name):
+        return Collection(self.server, name)
+
+    def command(self, command, *args, **kwargs):
+        if not isinstance(command, basestring):
+            command = command.keys()[0]
+        self.server.request(command)
+        return {'size': 900 * 1024 * 1024, 'storageSize': 1024 * 1024 * 1024}
+
+    def collection_names(self):
+        self.server.request("listCollections")
+        return ['oplog.rs', 'system.replset']
+
+
+class Client(object):
+    def __init__(self, server):
+        self.server = server
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Database(self.server, name)
+
+    def __getitem__(self, name):
+        return Database(self.server, name)
+
+
+class SON(dict):
+    def __init__(self, items):
+        dict.__init__(self, items)
+
+
+class FakePymongo(object):
+    ASCENDING = 1
+    DESCENDING = -1
+
+    class son_manipulator(object):
+        SON = SON
+
+    class errors(object):
+        class OperationFailure(Exception):
+            pass
+
+
+#
+# The oplog reads of check_mongodb.py before the shared oplog window helper
+#
+def old_check_oplog(pymongo, con):
+    db = con.local
+    ol = db.system.namespaces.find_one({"name": "local.oplog.rs"})
+    if (db.system.namespaces.find_one({"name": "local.oplog.rs"}) != None):
+        oplog = "oplog.rs"
+    else:
+        ol = db.system.namespaces.find_one({"name": "local.oplog.$main"})
+        if (db.system.namespaces.find_one({"name": "local.oplog.$main"}) != None):
+            oplog = "oplog.$main"
+        else:
+            return None
+    data = con.local.command(pymongo.son_manipulator.SON([('collstats', oplog)]))
+    ol = con.local[oplog]
+    firstc = ol.find().sort("$natural", pymongo.ASCENDING).limit(1)[0]['ts']
+    lastc = ol.find().sort("$natural", pymongo.DESCENDING).limit(1)[0]['ts']
+    return lastc.time - firstc.time
+
+
+def old_replication_get_time_diff(con):
+    col = 'oplog.rs'
+    local = con.local
+    ol = local.system.namespaces.find_one({"name": "local.oplog.$main"})
+    if ol:
+        col = 'oplog.$main'
+    firstc = local[col].find().sort("$natural", 1).limit(1)
+    lastc = local[col].find().sort("$natural", -1).limit(1)
+    first = firstc.next()
+    last = lastc.next()
+    return last["ts"].time - first["ts"].time
+
+
+def run(name, cycle, server, cycles):
+    del server.requests[:]
+    started = time.time()
+    for i in range(cycles):
+        cycle()
+    elapsed = time.time() - started
+    kinds = {}
+    for request in server.requests:
+        kinds[request] = kinds.get(request, 0) + 1
+    print "%-14s %5.1f requests/cycle  %7.1f ms/cycle  (%s)" % (name, float(len(server.requests)) / cycles, elapsed / cycles * 1000,
+        ", ".join(["%s: %d" % item for item in sorted(kinds.items())]))
+
+
+def main():
+    p = optparse.OptionParser(description="Benchmark the oplog window round trips of check_mongodb.py.")
+    p.add_option('--cycles', type='int', default=10, help='Poll cycles to simulate (default 10)')
+    p.add_option('--latency', type='float', default=1, help='Milliseconds added to every request (default 1)')
+    p.add_option('--dir', default=None, help='Directory the state store is kept in while benchmarking (default: the system temporary directory)')
+    options, arguments = p.parse_args()
+
+    plugin = imp.load_source('check_mongodb', PLUGIN)
+    plugin.pymongo = FakePymongo
+    plugin.son = FakePymongo.son_manipulator
+    plugin.set_read_preference = lambda db: None
+
+    directory = tempfile.mkdtemp(prefix='bench_mongodb_oplog.', dir=options.dir)
+    plugin.build_state_file_name = lambda: os.path.join(directory, 'state.db')
+    server = Server(options.latency / 1000.0)
+    con = Client(server)
+    devnull = open(os.devnull, 'w')
+
+    def new_cycle():
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            try:
+                plugin.check_oplog(con, 'mongo1', 27017, 0, 0, False)
+            except SystemExit:
+                # check_levels() exits with the state
+                pass
+        finally:
+            sys.stdout = stdout
+        plugin.get_oplog_window(con, 'mongo1', 27017)
+
+    try:
+        print "%d poll cycles of the oplog action and the replication_lag_percent oplog window" % options.cycles
+        run("before", lambda: (old_check_oplog(FakePymongo, con), old_replication_get_time_diff(con)), server, options.cycles)
+        run("oplog helper", new_cycle, server, options.cycles)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
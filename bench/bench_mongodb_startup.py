@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Benchmark of the cold-start time of check_mongodb.py per action.
+#
+# Every action is run --runs times as a fresh interpreter, the way Nagios runs
+# it, and the median wall time is reported together with the median of each
+# --profile-startup step (module, import_pymongo, connect, action).
+# --compare runs another copy of the plugin the same way, e.g. one taken from
+# an older commit with "git show <commit>:Nagios/libexec/check_mongodb.py", and
+# reports its wall time next to it (older copies have no --profile-startup).
+#
+# Usage: bench_mongodb_startup.py [-H host] [-P port] [--actions a,b] [--runs 5] [--compare FILE] [-- plugin options]
+#
+
+import sys
+import os
+import re
+import imp
+import time
+import optparse
+import subprocess
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Nagios', 'libexec', 'check_mongodb.py')
+STEPS = ['module', 'import_pymongo', 'connect', 'action']
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[len(values) / 2]
+
+
+def run_plugin(python, plugin, args, profile):
+    """ Runs the plugin once, returns (wall seconds, {step: seconds}, return code) """
+    if profile:
+        args = args + ['--profile-startup']
+    started = time.time()
+    process = subprocess.Popen([python, plugin] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    elapsed = time.time() - started
+    steps = {}
+    match = re.search(r'Startup profile: (.*)', err)
+    if match:
+        for step in match.group(1).split(', '):
+            name, value = step.split('=')
+            steps[name] = float(value.rstrip('s'))
+    return elapsed, steps, process.returncode
+
+
+def format_ms(value):
+    if value is None:
+        return "%8s" % "-"
+    return "%6.1fms" % (value * 1000)
+
+
+def main():
+    p = optparse.OptionParser(description="Benchmark the cold-start time of check_mongodb.py per action.")
+    p.add_option('-H', '--host', default='127.0.0.1', help='The mongod to check (default 127.0.0.1)')
+    p.add_option('-P', '--port', default='27017', help='The port of the mongod (default 27017)')
+    p.add_option('--actions', default=None, help='Comma separated actions to time (default: every action of the registry)')
+    p.add_option('--runs', type='int', default=5, help='Runs per action, the median is reported (default 5)')
+    p.add_option('--python', default=sys.executable, help='Interpreter the plugin is run with (default: this one)')
+    p.add_option('--compare', default=None, help='Another copy of check_mongodb.py to time next to this one')
+    options, arguments = p.parse_args()
+
+    if options.actions:
+        actions = options.actions.split(',')
+    else:
+        actions = sorted(imp.load_source('check_mongodb', PLUGIN).ACTIONS.keys())
+
+    header = "%-32s %9s" % ("action", "wall")
+    header += "".join([" %9s" % step for step in STEPS])
+    if options.compare:
+        header += " %9s" % "compare"
+    print header
+
+    for action in actions:
+        args = ['-H', options.host, '-P', options.port, '-A', action] + arguments
+        walls = []
+        steps = dict([(step, []) for step in STEPS])
+        codes = set()
+        for i in range(options.runs):
+            elapsed, profile, code = run_plugin(options.python, PLUGIN, args, True)
+            walls.append(elapsed)
+            codes.add(code)
+            for step in profile:
+                if step in steps:
+                    steps[step].append(profile[step])
+        line = "%-32s %9s" % (action, format_ms(median(walls)))
+        line += "".join([" %9s" % format_ms(median(steps[step])) for step in STEPS])
+        if options.compare:
+            line += " %9s" % format_ms(median([run_plugin(options.python, options.compare, args, False)[0] for i in range(options.runs)]))
+        line += "  exit %s" % ",".join([str(code) for code in sorted(codes)])
+        print line
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Microbenchmark of the delta state kept by check_mongodb.py between runs:
+# the SQLite state store against the per-(host, action) text files under
+# /tmp/check_mongodb_data/ that it replaced.
+#
+# Every simulated check stores new counters and reads the previous ones, as
+# maintain_delta() does for opcounters, current_lock, page_faults and asserts.
+# Reported per check: wall time, read/write syscalls and bytes from
+# /proc/self/io (Linux only), and with --processes, how many checks of
+# concurrent processes read state another process was writing at the time.
+#
+# Usage: bench_mongodb_state.py [--hosts 100] [--rounds 20] [--processes 8] [--dir DIR]
+#
+
+import sys
+import os
+import imp
+import time
+import random
+import shutil
+import optparse
+import tempfile
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Nagios', 'libexec', 'check_mongodb.py')
+ACTIONS = ['opcounters', 'current_lock', 'page_faults', 'asserts']
+
+
+#
+# The text file state of check_mongodb.py before the state store
+#
+def text_file_name(directory, host, port, action):
+    return os.path.join(directory, host + "-" + str(port) + "-" + action + ".data")
+
+
+def text_maintain_delta(directory, new_vals, host, port, action):
+    file_name = text_file_name(directory, host, port, action)
+    try:
+        f = open(file_name, 'r')
+        data = f.read()
+        f.close()
+    except IOError:
+        data = None
+    new_vals = [str(int(time.time()))] + new_vals
+    err = 0
+    if data == '':
+        # read between the truncation and the write of another check
+        err = 2
+    elif data:
+        try:
+            old_vals = data.split(';')
+            if len(old_vals) != len(new_vals):
+                raise ValueError(data)
+            [float(x) for x in old_vals]
+        except ValueError:
+            # torn read of a file another check was rewriting
+            err = 2
+    f = open(file_name, 'w')
+    f.write(";".join([str(x) for x in new_vals]))
+    f.close()
+    return err
+
+
+def store_maintain_delta(plugin, new_vals, host, port, action):
+    err, delta = plugin.maintain_delta(new_vals, host, port, action)
+    return err == 2 and 2 or 0
+
+
+def read_proc_io():
+    values = {}
+    try:
+        for line in open('/proc/self/io'):
+            name, value = line.split(':')
+            values[name] = int(value)
+    except IOError:
+        pass
+    return values
+
+
+def run(check, keys, rounds):
+    """ Runs rounds checks of every key, returns (seconds, /proc/self/io deltas, errors) """
+    errors = 0
+    io_before = read_proc_io()
+    started = time.time()
+    for i in range(rounds):
+        random.shuffle(keys)
+        for host, action in keys:
+            errors += check([i, i * 2, i * 3], host, 27017, action) == 2
+    elapsed = time.time() - started
+    io_after = read_proc_io()
+    io = dict([(name, io_after[name] - io_before.get(name, 0)) for name in io_after])
+    return elapsed, io, errors
+
+
+def run_concurrently(check, keys, rounds, processes):
+    """ Runs the same checks in several processes at once, returns the number of errors """
+    children = []
+    for p in range(processes):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            random.seed(p)
+            elapsed, io, errors = run(check, list(keys), rounds)
+            os.write(w, str(errors))
+            os._exit(0)
+        os.close(w)
+        children.append((pid, r))
+
+    errors = 0
+    for pid, r in children:
+        errors += int(os.read(r, 64) or 0)
+        os.close(r)
+        os.waitpid(pid, 0)
+    return errors
+
+
+def report(name, checks, elapsed, io, errors, directory):
+    files = os.listdir(directory)
+    size = sum([os.path.getsize(os.path.join(directory, f)) for f in files])
+    print "%-12s %8.1f us/check  %5.1f syscr  %5.1f syscw  %7.0f rchar  %7.0f wchar  %5d files %9d bytes  %d errors" % (
+        name, elapsed / checks * 1e6,
+        float(io.get('syscr', 0)) / checks, float(io.get('syscw', 0)) / checks,
+        float(io.get('rchar', 0)) / checks, float(io.get('wchar', 0)) / checks,
+        len(files), size, errors)
+
+
+def main():
+    p = optparse.OptionParser(description="Benchmark the check_mongodb.py delta state store against text files.")
+    p.add_option('--hosts', type='int', default=100, help='Number of simulated mongod hosts (default 100)')
+    p.add_option('--rounds', type='int', default=20, help='Checks of every host and action (default 20)')
+    p.add_option('--processes', type='int', default=8, help='Concurrent processes for the race test, 0 to skip it (default 8)')
+    p.add_option('--dir', default=None, help='Directory the state is kept in while benchmarking (default: the system temporary directory)')
+    options, arguments = p.parse_args()
+
+    plugin = imp.load_source('check_mongodb', PLUGIN)
+    keys = [("mongo%03d" % h, action) for h in range(options.hosts) for action in ACTIONS]
+    checks = len(keys) * options.rounds
+
+    print "%d keys, %d checks per run" % (len(keys), checks)
+    for name, make_check in [
+            ("text files", lambda d: lambda vals, host, port, action: text_maintain_delta(d, vals, host, port, action)),
+            ("state store", lambda d: lambda vals, host, port, action: store_maintain_delta(plugin, vals, host, port, action))]:
+        directory = tempfile.mkdtemp(prefix='bench_mongodb_state.', dir=options.dir)
+        plugin.build_state_file_name = lambda: os.path.join(directory, 'state.db')
+        try:
+            check = make_check(directory)
+            elapsed, io, errors = run(check, list(keys), options.rounds)
+            report(name, checks, elapsed, io, errors, directory)
+            if options.processes:
+                errors = run_concurrently(check, keys, options.rounds, options.processes)
+                print "%-12s %d of %d concurrent checks read torn or unreadable state" % ("", errors, checks * options.processes)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
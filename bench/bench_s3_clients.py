@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Benchmark of the time check_s3.py spends creating AWS clients, which load and
+# parse botocore's service models, in a run that talks to --buckets buckets
+# spread over --regions.
+#
+# Every mode is run --runs times as a fresh interpreter, the way Nagios runs
+# the plugin, and the median is reported:
+#   per call     a new boto3 client for every bucket, as check_s3.py did before
+#                get_client()
+#   get_client   one client per (service, region) through get_client()
+#   model cold   get_client() with an empty --modelcache directory
+#   model warm   get_client() with the --modelcache the cold runs filled
+# No request is sent, so no credentials are needed, but boto3 must be installed.
+#
+# Usage: bench_s3_clients.py [--buckets 50] [--regions us-east-1,eu-west-1] [--runs 5] [--dir DIR]
+#
+
+import sys
+import os
+import imp
+import time
+import shutil
+import optparse
+import tempfile
+import subprocess
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Nagios', 'libexec', 'check_s3.py')
+MODES = ['per call', 'get_client', 'model cold', 'model warm']
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def load_plugin(path):
+    # check_s3.py runs main() when imported, so its source is run without that last line
+    source = open(path).read()
+    plugin = imp.new_module('check_s3')
+    plugin.__file__ = path
+    exec compile(source.rsplit('\nmain()', 1)[0], path, 'exec') in plugin.__dict__
+    return plugin
+
+
+def child(mode, buckets, regions, modelcache):
+    """ Creates the clients of one run, prints the seconds it took """
+    started = time.time()
+    plugin = load_plugin(PLUGIN)
+    plugin.options = optparse.Values({'accesskeyid': None, 'secretaccesskey': None, 'modelcache': modelcache})
+    for i in range(buckets):
+        region = regions[i % len(regions)]
+        if mode == 'per call':
+            plugin.boto3.client('cloudwatch', region_name=region)
+            plugin.boto3.client('s3', region_name=region)
+        else:
+            plugin.get_client('cloudwatch', region)
+            plugin.get_client('s3', region)
+    print time.time() - started
+
+
+def run_child(mode, options, modelcache):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', mode,
+                                '--buckets', str(options.buckets), '--regions', options.regions,
+                                '--modelcache', modelcache], stdout=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode:
+        sys.exit(process.returncode)
+    return float(out)
+
+
+def main():
+    p = optparse.OptionParser(description="Benchmark the AWS client creation of check_s3.py.")
+    p.add_option('--buckets', type='int', default=50, help='Buckets the simulated run checks (default 50)')
+    p.add_option('--regions', default='us-east-1,eu-west-1', help='Comma separated regions the buckets are in (default us-east-1,eu-west-1)')
+    p.add_option('--runs', type='int', default=5, help='Runs per mode, the median is reported (default 5)')
+    p.add_option('--dir', default=None, help='Directory the model cache is kept in while benchmarking (default: the system temporary directory)')
+    p.add_option('--child', default=None, help=optparse.SUPPRESS_HELP)
+    p.add_option('--modelcache', default='', help=optparse.SUPPRESS_HELP)
+    options, arguments = p.parse_args()
+
+    if options.child:
+        child(options.child, options.buckets, options.regions.split(','), options.modelcache)
+        return
+
+    print "%d buckets in %s, a cloudwatch and an s3 client each" % (options.buckets, options.regions)
+    directory = tempfile.mkdtemp(prefix='bench_s3_clients.', dir=options.dir)
+    try:
+        for mode in MODES:
+            times = []
+            for i in range(options.runs):
+                modelcache = ''
+                if mode.startswith('model'):
+                    modelcache = os.path.join(directory, 'models')
+                    if mode == 'model cold':
+                        shutil.rmtree(modelcache, True)
+                times.append(run_child(mode, options, modelcache))
+            print "%-12s %8.1fms" % (mode, median(times) * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()